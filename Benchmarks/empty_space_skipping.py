@@ -0,0 +1,84 @@
+"""
+Times cast_screen_batch and cast_screen_parallel stepping through every tile against leaping across empty space with
+the map's distance field (Map.build_distance_field), and how long building and updating the field takes.
+Run from anywhere:
+    python Benchmarks/empty_space_skipping.py
+Besides the maps of the repository it generates open maps: a walled room, and rooms with scattered pillars
+"""
+import math
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+
+import FasterMap
+
+W, H = 1422, 800
+GENERATED_SIZE = 512
+ANGLES = 16  # view directions every case is cast in
+
+
+def room(size, pillars):
+    """An empty room walled on its edges, with a fraction pillars of its tiles as scattered pillars"""
+    rng = np.random.default_rng(0)
+    tiles = (rng.random((size, size)) < pillars).astype(np.uint8)
+    tiles[[0, -1], :] = 1
+    tiles[:, [0, -1]] = 1
+    tiles[size // 2, size // 2] = 0
+    return tiles
+
+
+def best_time(function, number):
+    return min(timeit.repeat(function, number=number, repeat=3)) / number
+
+
+def frame_time(cast, tiles, distances, resolution):
+    """Seconds to cast ANGLES frames from the center of tiles"""
+    columns = FasterMap.allocate_columns(W, resolution)
+    z_buffer = np.zeros(W, np.float64)
+    tex_sizes = np.full(int(tiles.max()) + 1, 64, np.int64)
+    pos_x, pos_y = tiles.shape[1] / 2 + .5, tiles.shape[0] / 2 + .5
+    camera_plane_length = math.tan(math.radians(45))
+    views = [(math.cos(angle), math.sin(angle)) for angle in np.linspace(0, 2 * math.pi, ANGLES, endpoint=False)]
+
+    def frames():
+        for dir_x, dir_y in views:
+            cast(columns, z_buffer, FasterMap.no_visits, distances, W, resolution, tiles, pos_x, pos_y, dir_x,
+                 -dir_y * camera_plane_length, dir_y, dir_x * camera_plane_length, H, 0, 1, tex_sizes, tex_sizes)
+
+    frames()  # compiles
+    return best_time(frames, 3) / ANGLES
+
+
+def main():
+    maps = {
+        'Assets/Maps/map2.txt': FasterMap.Map.load_file(os.path.join(ROOT, 'Assets', 'Maps', 'map2.txt')),
+        'Assets/MapsFiles/map.txt': FasterMap.Map.load_file(os.path.join(ROOT, 'Assets', 'MapsFiles', 'map.txt')),
+        f'room {GENERATED_SIZE}': room(GENERATED_SIZE, 0),
+        f'room {GENERATED_SIZE}, 0.1% pillars': room(GENERATED_SIZE, .001),
+        f'room {GENERATED_SIZE}, 1% pillars': room(GENERATED_SIZE, .01),
+    }
+    print(f'{"map":<30} {"kernel":<22} {"resolution":>10} {"stepping":>10} {"leaping":>10} {"speedup":>8}')
+    for name, tiles in maps.items():
+        tiles = tiles.astype(FasterMap.compact_dtype(tiles))
+        FasterMap.Map.instance = None
+        map_ = FasterMap.Map(tiles, None, None)
+        build = best_time(map_.build_distance_field, 3)
+        y, x = map_.shape[0] // 3, map_.shape[1] // 3
+        update = best_time(lambda: map_.set_tile(x, y, map_.get_tile(x, y)), 20)
+
+        for cast in (FasterMap.cast_screen_batch, FasterMap.cast_screen_parallel):
+            for resolution in (1, 3):
+                stepping = frame_time(cast, tiles, FasterMap.no_distances, resolution)
+                leaping = frame_time(cast, tiles, map_.distances, resolution)
+                print(f'{name:<30} {cast.__name__:<22} {resolution:>10} {stepping * 1000:8.3f}ms '
+                      f'{leaping * 1000:8.3f}ms {stepping / leaping:7.2f}x')
+        print(f'{name:<30} build_distance_field {build * 1000:.3f}ms, set_tile {update * 1000:.3f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+Micro-benchmarks of the numba kernels on the maps of Assets/Maps, across resolutions and view angles.
+Every kernel is called once before it is timed, so the JIT compilation is not measured. Run from anywhere:
+    python Benchmarks/kernel_benchmark.py --output before.json
+    python Benchmarks/kernel_benchmark.py --compare before.json
+    python Benchmarks/kernel_benchmark.py --tile-dtype int64 --output int64.json  # against the compact map arrays
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numba
+import numpy as np
+
+import FasterMap
+from Sprites3D.BillboardSprite import cast_sprite
+
+MAPS = sorted(glob.glob(os.path.join(ROOT, 'Assets', 'Maps', '*.txt')))
+TEXTURE_SIZE = 64
+TEXTURES = 4
+BIG_TEXTURE_TILE = 8  # texels per tile of the big floor texture
+SPRITES = 64
+
+
+def viewpoint(tiles):
+    """Center of the empty tile closest to the center of the map (in tiles)"""
+    center_y, center_x = tiles.shape[0] / 2, tiles.shape[1] / 2
+    empty_y, empty_x = (tiles == 0).nonzero()
+    closest = np.argmin((empty_y - center_y) ** 2 + (empty_x - center_x) ** 2)
+    return empty_x[closest] + .5, empty_y[closest] + .5
+
+
+def mip_atlas(count, size):
+    """count random palette indexed textures with their mip levels side by side, like pg_structures.pack_mip_atlas"""
+    levels = int(math.log2(size)) + 1
+    offsets = np.zeros((count, levels), np.int64)
+    offset = 0
+    for level in range(levels):
+        offsets[:, level] = offset
+        offset += max(1, size >> level)
+    rng = np.random.default_rng(0)
+    atlas = rng.integers(0, 127, (count, offset, size), dtype=np.int8)
+    sizes = np.full(count, size, np.int64)
+    return atlas, sizes, sizes.copy(), offsets
+
+
+def measure(function, repeat, number):
+    """Seconds per call of function: min, median and mean of repeat rounds of number calls"""
+    function()  # JIT warm-up
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        rounds.append((time.perf_counter() - start) / number)
+    return {'min': min(rounds), 'median': statistics.median(rounds), 'mean': statistics.mean(rounds)}
+
+
+def consume(generator):
+    for _ in generator:
+        pass
+
+
+def kernel_cases(tiles, W, H, resolutions, angles):
+    """Yields (kernel, resolution, angle, function) for every case of one map"""
+    pos_x, pos_y = viewpoint(tiles)
+    camera_plane_length = math.tan(math.radians(30))
+    tex_sizes = np.full(int(tiles.max()) + 1, TEXTURE_SIZE, np.int64)
+    floor_atlas, floor_widths, floor_heights, floor_offsets = mip_atlas(TEXTURES, TEXTURE_SIZE)
+    floor_map = (np.arange(tiles.size) % TEXTURES).reshape(tiles.shape).astype(tiles.dtype)
+    rng = np.random.default_rng(0)
+    big_texture = rng.integers(0, 127, (tiles.shape[1] * BIG_TEXTURE_TILE, tiles.shape[0] * BIG_TEXTURE_TILE),
+                               dtype=np.int8)
+    default_texture = np.zeros((BIG_TEXTURE_TILE, BIG_TEXTURE_TILE), np.int8)
+
+    ray_angles = np.linspace(0, 2 * math.pi, 720, endpoint=False)
+    ray_directions = np.stack((np.cos(ray_angles), np.sin(ray_angles)), axis=1)
+
+    def cast_rays():
+        for direction_x, direction_y in ray_directions:
+            FasterMap.cast_ray(tiles, pos_x, pos_y, direction_x, direction_y, tex_sizes, FasterMap.no_visits,
+                               FasterMap.no_distances)
+
+    yield 'cast_ray (720 rays)', None, None, cast_rays
+
+    for angle in angles:
+        dir_x, dir_y = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+        camera_x, camera_y = -dir_y * camera_plane_length, dir_x * camera_plane_length
+
+        for resolution in resolutions:
+            columns = FasterMap.allocate_columns(W, resolution)
+            z_buffer = np.zeros(W, np.float64)
+            visited = np.zeros(tiles.shape, np.uint8)
+            screen_args = (W, resolution, tiles, pos_x, pos_y, dir_x, camera_x, dir_y, camera_y, H, 0, 1,
+                           tex_sizes, tex_sizes)
+            yield 'cast_screen', resolution, angle, lambda: consume(FasterMap.cast_screen(*screen_args))
+            cast_args = (columns, z_buffer, visited, FasterMap.no_distances, *screen_args)
+            yield 'cast_screen_batch', resolution, angle, lambda: FasterMap.cast_screen_batch(*cast_args)
+            yield 'cast_screen_parallel', resolution, angle, lambda: FasterMap.cast_screen_parallel(*cast_args)
+
+        view = (dir_x, dir_y, camera_x, camera_y, W, H, pos_x, pos_y)
+        yield 'cast_floor_ceiling', None, angle, lambda: FasterMap.cast_floor_ceiling(
+            *view, floor_atlas, floor_widths, floor_heights, floor_offsets, floor_map, 1, 0, True)
+        yield 'cast_floor_ceiling_big_texture', None, angle, lambda: FasterMap.cast_floor_ceiling_big_texture(
+            *view, big_texture, BIG_TEXTURE_TILE, default_texture, 1, 0, True)
+
+        z_buffer = np.full(W, np.inf)
+        sprites = np.stack((pos_x + dir_x * np.linspace(1, 8, SPRITES) + camera_x * np.linspace(-4, 4, SPRITES),
+                            pos_y + dir_y * np.linspace(1, 8, SPRITES) + camera_y * np.linspace(-4, 4, SPRITES)),
+                           axis=1)
+
+        def cast_sprites():
+            for sprite_x, sprite_y in sprites:
+                consume(cast_sprite(sprite_x, sprite_y, pos_x, pos_y, camera_x, camera_y, dir_x, dir_y, W, H,
+                                    z_buffer, TEXTURE_SIZE, TEXTURE_SIZE, 1, 0, 0, 1, 1))
+
+        yield f'cast_sprite ({SPRITES} sprites)', None, angle, cast_sprites
+
+
+def run(maps, W, H, resolutions, angles, repeat, number, tile_dtype):
+    results = []
+    for path in maps:
+        tiles = FasterMap.Map.load_file(path)
+        if tile_dtype == 'compact':  # like FasterMap.Map does
+            tiles = tiles.astype(FasterMap.compact_dtype(tiles))
+        name = os.path.relpath(path, ROOT).replace(os.sep, '/')
+        print(f'{name}: {tiles.dtype} tiles, {tiles.nbytes} bytes ({tiles.size * 8} as int64)')
+        for kernel, resolution, angle, function in kernel_cases(tiles, W, H, resolutions, angles):
+            result = {'kernel': kernel, 'map': name, 'map_shape': list(tiles.shape), 'tile_dtype': tiles.dtype.name,
+                      'resolution': resolution, 'angle': angle, **measure(function, repeat, number)}
+            print(f'{kernel:<32} {name:<24} resolution {str(resolution):<5} angle {str(angle):<5} '
+                  f'{result["median"] * 1000:9.3f} ms')
+            results.append(result)
+    return results
+
+
+def case_key(result):
+    return result['kernel'], result['map'], result['resolution'], result['angle']
+
+
+def compare(results, path):
+    """Prints the median of every case against the one saved in path"""
+    with open(path) as file:
+        before = {case_key(result): result for result in json.load(file)['results']}
+    print(f'\ncompared to {path} (median, >1 is faster now):')
+    for result in results:
+        old = before.get(case_key(result))
+        if old is not None:
+            kernel, map_, resolution, angle = case_key(result)
+            print(f'{kernel:<32} {map_:<24} resolution {str(resolution):<5} angle {str(angle):<5} '
+                  f'{old["median"] / result["median"]:6.2f}x')
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='numba kernels micro-benchmarks')
+    parser.add_argument('--maps', nargs='+', default=MAPS, help='map files, all of Assets/Maps by default')
+    parser.add_argument('--size', default='1422x800', help='screen size, WxH')
+    parser.add_argument('--resolution', type=int, nargs='+', default=[1, 3])
+    parser.add_argument('--angle', type=float, nargs='+', default=[0, 45, 90, 200], help='view angles, degrees')
+    parser.add_argument('--tile-dtype', choices=('compact', 'int64'), default='compact',
+                        help='dtype of the map arrays, compact is the smallest that fits the ids (what Map uses)')
+    parser.add_argument('--repeat', type=int, default=5, help='rounds per case, the min / median / mean are saved')
+    parser.add_argument('--number', type=int, default=3, help='calls per round')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare against')
+    args = parser.parse_args()
+    W, H = (int(value) for value in args.size.lower().split('x'))
+
+    results = run(args.maps, W, H, args.resolution, args.angle, args.repeat, args.number, args.tile_dtype)
+    if args.compare is not None:
+        compare(results, args.compare)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump({'commit': commit(), 'numba': numba.__version__, 'numpy': np.__version__,
+                       'threads': numba.config.NUMBA_NUM_THREADS, 'size': [W, H], 'repeat': args.repeat,
+                       'number': args.number, 'results': results}, file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Times FasterMap.Map.load_file against the per tile Python parser it replaced, and against opening the same map in
+the binary format (FasterMap.read_binary_map). Run from anywhere:
+    python Benchmarks/map_loading.py
+Besides the maps of the repository it generates large maps of both layouts in a temporary directory
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+
+import FasterMap
+
+GENERATED_SIZE = 2000  # rows and columns of the generated maps
+
+
+def legacy_load_file(filename):
+    """The line by line parser Map.load_file used to be (it reads a row without spaces as one number)"""
+    with open(filename, 'r') as file:
+        map_ = []
+        line_size = None
+        for line in file:
+            line = line.replace('\n', '')
+            line = line.split(' ')
+            line = list(filter(lambda x: bool(x), line))
+            if (not len(line) == line_size) and (line_size is not None):
+                raise ValueError('Rows lengths are not uniform', line)
+            line_size = len(line)
+            map_.append([int(x) for x in line])
+    return map_
+
+
+def best_time(function, number):
+    return min(timeit.repeat(function, number=number, repeat=3)) / number
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    rng = np.random.default_rng(0)
+    tiles = rng.integers(0, 10, (GENERATED_SIZE, GENERATED_SIZE))
+    separated = os.path.join(directory, 'separated.txt')
+    compact = os.path.join(directory, 'compact.txt')
+    with open(separated, 'w') as file:
+        file.write('\n'.join(' '.join(map(str, row)) for row in tiles) + '\n')
+    with open(compact, 'w') as file:
+        file.write('\n'.join(''.join(map(str, row)) for row in tiles) + '\n')
+
+    maps = [os.path.join(ROOT, 'Assets', 'Maps', 'map2.txt'), os.path.join(ROOT, 'Assets', 'MapsFiles', 'map.txt'),
+            separated, compact]
+    print(f'{"map":<32} {"shape":<14} {"legacy":>10} {"load_file":>10} {"binary":>10}')
+    for path in maps:
+        number = 1 if os.path.getsize(path) > 1 << 20 else 20
+        tiles = FasterMap.Map.load_file(path)
+        binary = os.path.join(directory, os.path.basename(path) + '.rmap')
+        FasterMap.write_binary_map(binary, FasterMap.Map.TILE_SIZE, {'tiles': tiles})
+
+        legacy = best_time(lambda: legacy_load_file(path), number)
+        vectorized = best_time(lambda: FasterMap.Map.load_file(path), number)
+        mapped = best_time(lambda: FasterMap.read_binary_map(binary), number)
+        name = os.path.relpath(path, ROOT) if path.startswith(ROOT) else os.path.basename(path)
+        print(f'{name:<32} {str(tiles.shape):<14} {legacy * 1000:8.2f}ms {vectorized * 1000:8.2f}ms '
+              f'{mapped * 1000:8.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
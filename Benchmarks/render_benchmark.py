@@ -0,0 +1,176 @@
+"""
+Headless renderer benchmark: renders a scripted camera path through Render3D with the SDL dummy video driver and
+reports frames per second and the per stage times of structures.FrameProfiler. Run from anywhere:
+    python Benchmarks/render_benchmark.py --map map.txt --frames 300 --size 1422x800 --resolution 1 3
+    python Benchmarks/render_benchmark.py --path path.json --output results.json
+A path file is a JSON list of [x, y, angle, tilt] waypoints (x, y in tiles, angle in degrees), the camera moves
+between them at a constant rate over the frames. Without one the camera turns a full circle on the first empty tile
+next to the center of the map
+"""
+import argparse
+import importlib.util
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')  # before pygame opens a display
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+SCRIPT = os.path.abspath(__file__)
+ROOT = os.path.dirname(os.path.dirname(SCRIPT))
+CALLER_DIRECTORY = os.getcwd()  # the paths given as arguments are relative to it
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # the assets are loaded by relative paths
+
+import pygame
+
+import FasterMap
+import pg_structures
+import structures
+from Sprites3D import BillboardSprite, SpriteStore
+
+MAPS_DIRECTORY = os.path.join('Assets', 'Maps')
+
+
+def load_render_module():
+    spec = importlib.util.spec_from_file_location('render_3d', os.path.join(ROOT, 'Render 3D.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def default_path(map_):
+    """A full turn on the empty tile closest to the center of the map"""
+    tiles = map_.map()
+    center_y, center_x = tiles.shape[0] // 2, tiles.shape[1] // 2
+    empty = sorted(zip(*(tiles == 0).nonzero()), key=lambda tile: (tile[0] - center_y) ** 2 + (tile[1] - center_x) ** 2)
+    if not empty:
+        raise ValueError('The map has no empty tile to put the camera on')
+    y, x = empty[0]
+    return [[x + .5, y + .5, 0, 0], [x + .5, y + .5, 360, 0]]
+
+
+def camera_on_path(path, progress):
+    """(x, y, angle, tilt) at progress (0 to 1) along the waypoints of path"""
+    if len(path) == 1:
+        return path[0]
+    position = progress * (len(path) - 1)
+    index = min(int(position), len(path) - 2)
+    fraction = position - index
+    return [a + (b - a) * fraction for a, b in zip(path[index], path[index + 1])]
+
+
+def run(render, map_path, size, resolution, frames, warmup, path, pipelined):
+    pygame.init()
+    screen = pg_structures.DisplayMods.Windowed(size)
+    render.RenderSettings.Profile = True
+    BillboardSprite.BillboardSprite.initiate(render.RenderSettings)
+
+    map_ = FasterMap.Map.from_file(map_path)
+    if path is None:
+        path = default_path(map_)
+    player = render.Player3D(*map_.to_global(path[0][:2]))
+    renderer = render.Render3D(player, map_, screen)
+    renderer.resolution = resolution
+    if pipelined:
+        renderer.start_pipeline(render.RenderSettings.FramesInFlight, render.RenderSettings.LatencyBudget)
+
+    dt = 1 / 60  # fixed step, so every run animates the same
+    total = warmup + frames
+    start = None
+    for frame in range(total):
+        if frame == warmup:  # the first frames compile the kernels
+            renderer.profiler = structures.FrameProfiler(window=frames)
+            start = time.perf_counter()
+        x, y, angle, tilt = camera_on_path(path, frame / max(total - 1, 1))
+        player.position.set_ip(*map_.to_global((x, y)))
+        player.looking_direction.set_ip(math.cos(math.radians(angle)), math.sin(math.radians(angle)))
+        player.tilt = tilt
+
+        renderer.render()
+        with renderer.profiler.scope('update_all'):
+            SpriteStore.SpriteStore.update_all(dt)  # the player is scripted, only the free sprites move
+        renderer.prepare_next_frame()
+        with renderer.profiler.scope('display_update'):
+            pygame.display.update()
+        renderer.profiler.end_frame()
+    seconds = time.perf_counter() - start
+    renderer.stop_pipeline()
+
+    return {
+        'map': map_path,
+        'size': list(size),
+        'resolution': resolution,
+        'pipelined': pipelined,
+        'frames': frames,
+        'fps': frames / seconds,
+        'stages': renderer.profiler.summary(),
+    }
+
+
+def print_result(result):
+    print(f'{result["size"][0]}x{result["size"][1]} resolution {result["resolution"]}'
+          f'{" pipelined" if result["pipelined"] else ""}: {result["fps"]:.1f} fps')
+    for name, stats in result['stages'].items():
+        print(f'    {name:<18} p50 {stats["p50"] * 1000:7.2f} ms   p95 {stats["p95"] * 1000:7.2f} ms   '
+              f'p99 {stats["p99"] * 1000:7.2f} ms')
+
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless Render3D benchmark')
+    parser.add_argument('--map', default='map.txt', help=f'map file in {MAPS_DIRECTORY} (or a path)')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=10, help='frames rendered before measuring')
+    parser.add_argument('--size', type=parse_size, nargs='+', default=[(1422, 800)], help='screen sizes, WxH')
+    parser.add_argument('--resolution', type=int, nargs='+', default=[3], help='Render3D resolutions')
+    parser.add_argument('--path', help='JSON file of [x, y, angle, tilt] camera waypoints')
+    parser.add_argument('--pipelined', action='store_true', help='cast the next frame while drawing')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)  # one configuration, internal
+    args = parser.parse_args()
+
+    map_path = os.path.join(CALLER_DIRECTORY, args.map)
+    if not os.path.exists(map_path):
+        map_path = os.path.join(ROOT, MAPS_DIRECTORY, args.map)
+    path_file = None if args.path is None else os.path.join(CALLER_DIRECTORY, args.path)
+    path = None
+    if path_file is not None:
+        with open(path_file) as file:
+            path = json.load(file)
+
+    if args.single:  # the map and the renderer are singletons, so every configuration runs in its own process
+        result = run(load_render_module(), map_path, args.size[0], args.resolution[0], args.frames, args.warmup, path,
+                     args.pipelined)
+        json.dump(result, sys.stdout)
+        return
+
+    results = []
+    for size in args.size:
+        for resolution in args.resolution:
+            command = [sys.executable, SCRIPT, '--single', '--map', map_path,
+                       '--frames', str(args.frames), '--warmup', str(args.warmup),
+                       '--size', f'{size[0]}x{size[1]}', '--resolution', str(resolution)]
+            if path_file is not None:
+                command += ['--path', path_file]
+            if args.pipelined:
+                command.append('--pipelined')
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print_result(result)
+            results.append(result)
+
+    if args.output is not None:
+        with open(os.path.join(CALLER_DIRECTORY, args.output), 'w') as file:
+            json.dump(results, file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Counts the Vector2s allocated per frame by the player / camera hot paths: the real Player3D.update_bef, Player.move
+(W and D held), BaseSprite.update_kinematics (with the wall collisions of the map) and Vector2.camera_basis (once for
+the walls, the background and the sprites), headless with the SDL dummy video driver. They are compared against the
+same paths written with the allocating Vector2 arithmetic they used before the in place operations (AllocatingPlayer).
+Run from anywhere:
+    python Benchmarks/vector_allocations.py
+"""
+import importlib.util
+import os
+import sys
+import timeit
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')  # before pygame opens a display
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # the assets are loaded by relative paths
+
+import pygame
+
+import FasterMap
+import pg_structures
+import structures
+from Sprites3D import BillboardSprite
+from Sprites3D.Sprites import BaseSprite
+from structures import RotationMatrix, Vector2
+
+FRAMES = 10000
+DT = 1 / 60
+MAP = os.path.join('Assets', 'MapsFiles', 'map.txt')
+
+
+def load_render_module():
+    spec = importlib.util.spec_from_file_location('render_3d', os.path.join(ROOT, 'Render 3D.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def allocating_player(render):
+    """Player3D with the hot paths as they were written before the in place Vector2 operations"""
+
+    class AllocatingPlayer(render.Player3D):
+        def update_bef(self, dt, keys):
+            diffX = pygame.mouse.get_pos()[0] - pg_structures.DisplayMods.current_width / 2
+            self.looking_direction = self.looking_direction * RotationMatrix(diffX / render.RenderSettings.fov() * 30,
+                                                                             False)
+            diffY = pygame.mouse.get_pos()[1] - pg_structures.DisplayMods.current_height / 2
+            self.tilt -= diffY * self.sensitivity_y
+
+            pygame.mouse.set_pos(pg_structures.DisplayMods.current_width / 2,
+                                 pg_structures.DisplayMods.current_height / 2)
+
+            self.ground_height = 1
+            if self.speed == self.running_speed:
+                self.speed = self.regular_speed
+
+        def move(self, keys, dt):
+            self.moving_direction.x = 0
+            self.moving_direction.y = 0
+            for key, function in self.key_to_function.items():
+                if keys[key]:
+                    function()
+
+            self.velocity = self.speed * self.moving_direction
+
+        def set_moving_direction(self, x=None, y=None):
+            if self.moving_direction:
+                self.moving_direction = self.moving_direction.normalized()
+            self.moving_direction += Vector2(x or 0, y or 0)
+            if self.moving_direction:
+                self.moving_direction = self.moving_direction.normalized()
+
+        def setup_movement(self):
+            super(AllocatingPlayer, self).setup_movement()
+            self.key_to_function[pygame.K_w] = lambda: self.set_moving_direction(*self.looking_direction)
+            self.key_to_function[pygame.K_d] = \
+                lambda: self.set_moving_direction(*(self.looking_direction * RotationMatrix.ROT90))
+            self.key_to_function[pygame.K_s] = \
+                lambda: self.set_moving_direction(*(self.looking_direction * RotationMatrix.ROT180))
+            self.key_to_function[pygame.K_a] = \
+                lambda: self.set_moving_direction(*(self.looking_direction * RotationMatrix.ROT270))
+
+        def base_update_kinematics(self, dt):
+            """BaseSprite.update_kinematics"""
+            displacement = self.velocity * dt
+            self.position.x += displacement.x
+
+            if self.wall_collision:
+                self.x_collision(displacement)
+
+            self.position.y += displacement.y
+
+            if self.wall_collision:
+                self.y_collision(displacement)
+
+        @staticmethod
+        def camera_basis(looking_direction, camera_plane_length):
+            dir_ = looking_direction.normalized()
+            camera_plane = dir_.tangent() * camera_plane_length
+            return dir_.x, dir_.y, camera_plane.x, camera_plane.y
+
+    return AllocatingPlayer
+
+
+def make_player(player_class, render):
+    BillboardSprite.BillboardSprite.initiate(render.RenderSettings)
+    FasterMap.Map.instance = None
+    FasterMap.Map.from_file(MAP)
+    return player_class(100, 1500)
+
+
+def stages(player, camera_plane_length):
+    """The hot paths of a frame, by name"""
+    keys = {key: False for key in player.key_to_function}
+    keys[pygame.K_w] = keys[pygame.K_d] = True
+    if hasattr(player, 'base_update_kinematics'):  # AllocatingPlayer
+        base_update_kinematics, camera_basis = player.base_update_kinematics, player.camera_basis
+    else:
+        base_update_kinematics = lambda dt: BaseSprite.update_kinematics(player, dt)
+        camera_basis = Vector2.camera_basis
+
+    def camera_bases():
+        for _ in range(3):
+            camera_basis(player.looking_direction, camera_plane_length)
+
+    return {
+        'Player3D.update_bef': lambda: player.update_bef(DT, keys),
+        'Player.move': lambda: player.move(keys, DT),
+        'BaseSprite.update_kinematics': lambda: base_update_kinematics(DT),
+        'camera_basis x3': camera_bases,
+    }
+
+
+def count_allocations(function):
+    """Returns the number of Vector2s created per call of function"""
+    count = [0]
+    init = Vector2.__init__
+
+    def counting_init(self, x, y):
+        count[0] += 1
+        init(self, x, y)
+
+    Vector2.__init__ = counting_init
+    try:
+        for _ in range(FRAMES):
+            function()
+    finally:
+        Vector2.__init__ = init
+    return count[0] / FRAMES
+
+
+def main():
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+    render = load_render_module()
+    camera_plane_length = structures.DegTrigo.tan(render.RenderSettings.fov() / 2)
+
+    print(f'{"":<28} {"allocating":>31} {"in place":>31}')
+    results = []
+    for player_class in (allocating_player(render), render.Player3D):
+        player = make_player(player_class, render)
+        results.append({name: (count_allocations(function), timeit.timeit(function, number=FRAMES) / FRAMES)
+                        for name, function in stages(player, camera_plane_length).items()})
+        player.kill()
+    results = [dict(result, frame=tuple(map(sum, zip(*result.values())))) for result in results]
+    for name in results[0]:
+        print(f'{name:<28}', *(f'{allocations:6.2f} Vector2s {seconds * 1e6:7.2f} us/frame'
+                               for allocations, seconds in (result[name] for result in results)))
+    pygame.quit()
+
+
+if __name__ == '__main__':
+    main()
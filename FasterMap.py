@@ -1,7 +1,12 @@
+from collections import OrderedDict
 from typing import Tuple
+import itertools
+import json
+import math
+import warnings
 import structures
 import numpy as np
-from numba import njit
+from numba import njit, prange
 
 
 # arrauy
@@ -9,24 +14,35 @@ from numba import njit
 
 class Map(structures.Singleton):
     TILE_SIZE = 50
-
-    def __init__(self, tile_array, floor_array, ceiling_array, tile_size=TILE_SIZE):
-        self.__map: np.array = np.array(tile_array, np.int64)
-        if floor_array is not None:
-            self.floor_array: np.array = np.array(floor_array, np.int64)
+    LOAD_CHUNK_BYTES = 1 << 20  # text maps are parsed this much at a time
+    DISTANCE_CAP = 64  # largest distance build_distance_field stores, rays skip at most that many tiles at once
+
+    def __init__(self, tile_array, floor_array, ceiling_array, tile_size=TILE_SIZE, sprites=None, dtype=None):
+        """dtype of the tile, floor and ceiling arrays, by default the smallest of TILE_DTYPES their ids fit in"""
+        arrays = [None if array is None else np.asarray(array) for array in (tile_array, floor_array, ceiling_array)]
+        if dtype is None:
+            dtype = compact_dtype(*arrays)
+        # astype doesn't copy arrays that already are of dtype, like the memory mapped arrays of from_binary
+        self.__map: np.array = arrays[0].astype(dtype, copy=False)
+        if arrays[1] is not None:
+            self.floor_array: np.array = arrays[1].astype(dtype, copy=False)
         else:
             self.floor_array = None
 
-        if ceiling_array is not None:
-            self.ceiling_array: np.array = np.array(ceiling_array, np.int64)
+        if arrays[2] is not None:
+            self.ceiling_array: np.array = arrays[2].astype(dtype, copy=False)
         else:
             self.ceiling_array = None
+        self.sprites = sprites  # (n, 3) array of x, y (in tiles) and texture id, None if the map has no sprite list
 
         floor_match = self.floor_array is None or self.floor_array.shape == self.__map.shape
         ceiling_match = self.ceiling_array is None or self.ceiling_array.shape == self.__map.shape
         if not (floor_match and ceiling_match):
             raise ValueError('Maps are not the same size', self.floor_array.shape, self.__map.shape)
         self.tile_size = tile_size
+        self.origin = (0, 0)  # world tile of map()[0, 0], it moves in a ChunkedMap
+        self.distances = no_distances  # see build_distance_field
+        self.distance_cap = 0
 
         self.width = len(self.columns())
         self.height = len(self.rows())
@@ -38,6 +54,19 @@ class Map(structures.Singleton):
     def shape(self):
         return self.__map.shape
 
+    @property
+    def dtype(self):
+        return self.__map.dtype
+
+    @property
+    def nbytes(self):
+        """Memory of the tile, floor and ceiling arrays"""
+        return sum(array.nbytes for array in (self.__map, self.floor_array, self.ceiling_array) if array is not None)
+
+    def memory_saved(self):
+        """Bytes saved by the compact dtype, compared to int64 arrays"""
+        return self.nbytes // self.dtype.itemsize * np.dtype(np.int64).itemsize - self.nbytes
+
     @classmethod
     def from_file(cls, map_, floor_map=None, ceiling_map=None):
         if floor_map is not None:
@@ -46,20 +75,47 @@ class Map(structures.Singleton):
             ceiling_map = cls.load_file(ceiling_map)
         return cls(cls.load_file(map_), floor_map, ceiling_map)
 
-    @staticmethod
-    def load_file(filename):
-        with open(filename, 'r') as file:
-            map_ = []
-            line_size = None
-            for line in file:
-                line = line.replace('\n', '')
-                line = line.split(' ')
-                line = list(filter(lambda x: bool(x), line))
-                if (not len(line) == line_size) and (line_size is not None):
-                    raise ValueError('Rows lengths are not uniform', line)
-                line_size = len(line)
-                map_.append([int(x) for x in line])
-        return map_
+    @classmethod
+    def from_binary(cls, filename):
+        """Opens a map saved by save_binary. The arrays are memory mapped, so it takes the same time for any size"""
+        tile_size, arrays = read_binary_map(filename)
+        tiles, floor, ceiling = arrays['tiles'], arrays.get('floor'), arrays.get('ceiling')
+        # saved maps are compact already, compact_dtype would read every array from the disk
+        dtype = np.result_type(*(array for array in (tiles, floor, ceiling) if array is not None))
+        return cls(tiles, floor, ceiling, tile_size, arrays.get('sprites'), dtype)
+
+    def save_binary(self, filename):
+        arrays = {'tiles': self.__map, 'floor': self.floor_array, 'ceiling': self.ceiling_array,
+                  'sprites': self.sprites}
+        write_binary_map(filename, self.tile_size, {name: array for name, array in arrays.items() if array is not None})
+
+    @classmethod
+    def load_file(cls, filename, chunk_bytes=None):
+        """
+        Reads a text map into an int64 array. The tiles of a row are separated by spaces, or are one digit each
+        without spaces (like Assets/Maps/map2.txt). Blank lines are skipped and all rows must have the same length.
+        The file is read and parsed about chunk_bytes at a time (whole lines) with numpy
+        """
+        chunk_bytes = chunk_bytes or cls.LOAD_CHUNK_BYTES
+        chunks = []
+        width = separated = None
+        with open(filename, 'rb') as file:
+            for lines in iter(lambda: file.readlines(chunk_bytes), []):
+                text = b''.join(lines)
+                if not text.strip():
+                    continue
+                if separated is None:
+                    first_line = text.strip().split(b'\n', 1)[0]
+                    separated = len(first_line.split()) > 1
+                rows = parse_separated_rows(text) if separated else parse_compact_rows(text)
+                if width is None:
+                    width = rows.shape[1]
+                elif rows.shape[1] != width:
+                    raise ValueError('Rows lengths are not uniform', filename)
+                chunks.append(rows)
+        if not chunks:
+            return np.zeros((0, 0), np.int64)
+        return np.concatenate(chunks)
 
     def __str__(self):
         return '\n'.join(' '.join(line) for line in self.__map)
@@ -70,7 +126,8 @@ class Map(structures.Singleton):
         return position[0] * self.tile_size, position[1] * self.tile_size
 
     def to_local(self, position):
-        return position[0] / self.tile_size, position[1] / self.tile_size
+        """Global position to tiles of the arrays the kernels get (map(), floor_array and ceiling_array)"""
+        return position[0] / self.tile_size - self.origin[0], position[1] / self.tile_size - self.origin[1]
 
     def get_size(self):
         return self.width, self.height
@@ -80,7 +137,57 @@ class Map(structures.Singleton):
 
     def get_tile_global(self, x, y):
         x, y = int(x // self.tile_size), int(y // self.tile_size)
-        return self.get_tile(x, y), (x * self.tile_size, y * self.tile_size, self.tile_size, self.tile_size)
+        return self.get_tile(x - self.origin[0], y - self.origin[1]), \
+            (x * self.tile_size, y * self.tile_size, self.tile_size, self.tile_size)
+
+    def set_tile(self, x, y, tile):
+        """Changes a tile (of map()) and the distance field around it, if it was built"""
+        self.__map[y, x] = tile
+        if self.distances.size:
+            cap = self.distance_cap
+            height, width = self.shape
+            chebyshev_distances(self.__map, self.distances, max(x - cap, 0), max(y - cap, 0), min(x + cap + 1, width),
+                                min(y + cap + 1, height), cap)
+
+    def build_distance_field(self, cap=DISTANCE_CAP):
+        """
+        Builds distances, the Chebyshev distance (in tiles, at most cap) of every tile to the nearest wall or to the
+        edge of the map, that lets the cast kernels leap across empty space. It is kept up to date by set_tile
+        """
+        if not 2 < cap <= np.iinfo(np.uint8).max:
+            raise ValueError('The distance cap must be between 3 and 255', cap)
+        self.distance_cap = cap
+        self.distances = np.zeros(self.shape, np.uint8)
+        chebyshev_distances(self.__map, self.distances, 0, 0, self.shape[1], self.shape[0], cap)
+        return self.distances
+
+    def update(self, position):
+        """Keeps the tiles around position (global) in memory, the whole map already is. Returns whether they changed"""
+        return False
+
+    def will_update(self, position):
+        """Whether update(position) would change the arrays the kernels get"""
+        return False
+
+    def collide_box(self, x, y, half_width, half_height, displacement, axis):
+        """resolve_box against the walls, for a global position. Returns the corrected coordinate on axis"""
+        offset_x = self.origin[0] * self.tile_size
+        offset_y = self.origin[1] * self.tile_size
+        local = (x - offset_x, y - offset_y)
+        corrected = resolve_box(self.__map, self.tile_size, local[0], local[1], half_width, half_height, displacement,
+                                axis)
+        if corrected == local[axis]:  # didn't hit, return it untouched by the offset
+            return (x, y)[axis]
+        return corrected + (offset_x, offset_y)[axis]
+
+    def collide_boxes(self, positions, half_sizes, displacements, axis):
+        """resolve_boxes against the walls, positions (n, 2) are global and are corrected in place"""
+        offset = np.multiply(self.origin, self.tile_size)
+        local = positions - offset
+        before = local[:, axis].copy()
+        resolve_boxes(self.__map, self.tile_size, local, half_sizes, displacements, axis)
+        hit = local[:, axis] != before
+        positions[hit, axis] = local[hit, axis] + offset[axis]
 
     def __getitem__(self, item):
         if isinstance(item, int):
@@ -97,19 +204,259 @@ class Map(structures.Singleton):
         return self.__map.T
 
     def cast_ray(self, startX, startY, directionX, directionY):
-        return cast_ray(self.__map, startX, startY, directionX, directionY, 1)
+        return cast_ray(self.__map, startX, startY, directionX, directionY, 1, no_visits, self.distances)
+
+
+def parse_separated_rows(text):
+    """Rows of whitespace separated integers (bytes of whole lines) to an int64 array"""
+    data = np.frombuffer(text, np.uint8)
+    in_token = data > ord(' ')
+    starts = in_token.copy()
+    starts[1:] &= ~in_token[:-1]
+    line_of_byte = np.cumsum(data == ord('\n'))
+    tokens_per_line = np.bincount(line_of_byte[starts])
+    tokens_per_line = tokens_per_line[tokens_per_line > 0]  # blank lines
+    if (tokens_per_line != tokens_per_line[0]).any():
+        raise ValueError('Rows lengths are not uniform', tokens_per_line)
+    with warnings.catch_warnings():  # fromstring warns when it stops at a bad token, the count is checked instead
+        warnings.simplefilter('ignore', DeprecationWarning)
+        values = np.fromstring(text, np.int64, sep=' ')
+    if len(values) != tokens_per_line.sum():
+        raise ValueError('Tiles of a map must be integers')
+    return values.reshape(len(tokens_per_line), tokens_per_line[0])
+
+
+def parse_compact_rows(text):
+    """Rows of one digit per tile (bytes of whole lines) to an int64 array"""
+    data = np.frombuffer(text, np.uint8)
+    data = data[(data != ord('\r')) & (data != ord(' ')) & (data != ord('\t'))]
+    newlines = np.flatnonzero(data == ord('\n'))
+    line_ends = np.append(newlines, len(data))
+    lengths = np.diff(line_ends, prepend=-1) - 1
+    lengths = lengths[lengths > 0]  # blank lines
+    if (lengths != lengths[0]).any():
+        raise ValueError('Rows lengths are not uniform', lengths)
+    digits = data[data != ord('\n')]
+    if ((digits < ord('0')) | (digits > ord('9'))).any():
+        raise ValueError('Tiles of a map without spaces must be digits')
+    return (digits - ord('0')).astype(np.int64).reshape(len(lengths), lengths[0])
+
+
+class ChunkedMap(Map):
+    """
+    A world that is kept in memory only around the viewer. It is split to chunk_size x chunk_size chunks that
+    load_chunk returns, and map(), floor_array and ceiling_array are a fixed size window of the chunks that are at
+    most view_distance tiles from the viewer. update moves the window (origin) as the viewer moves, the kernels and
+    everything that goes through to_local / collide_box work the same as with a Map.
+    Rays end at the edge of the window and tiles outside it are empty for collisions.
+    Chunks that left the window are kept for a while in an LRU cache of cached_chunks chunks
+    """
+
+    def __init__(self, load_chunk, chunk_size=32, view_distance=64, tile_size=Map.TILE_SIZE, cached_chunks=64,
+                 floor=False, ceiling=False, position=(0, 0), dtype=np.uint16):
+        """
+        :param load_chunk: function (chunk_x, chunk_y) -> (tiles, floor, ceiling) chunk_size x chunk_size arrays
+            (floor / ceiling may be None if the world doesn't have them)
+        :param floor: whether the world has a floor texture map (and ceiling, the same)
+        :param position: global position the window starts around
+        :param dtype: of the window, the chunks are only seen one at a time so it has to fit every id of the world
+        """
+        self.load_chunk = load_chunk
+        self.chunk_size = chunk_size
+        self.radius = -(-view_distance // chunk_size)  # in chunks, around the viewer's chunk
+        self.chunks = OrderedDict()  # (chunk_x, chunk_y): (tiles, floor, ceiling)
+        self.cached_chunks = max(cached_chunks, (2 * self.radius + 1) ** 2)
+        side = (2 * self.radius + 1) * chunk_size
+        super(ChunkedMap, self).__init__(np.zeros((side, side), dtype),
+                                         np.zeros((side, side), dtype) if floor else None,
+                                         np.zeros((side, side), dtype) if ceiling else None, tile_size, dtype=dtype)
+        Map.instance = self  # everything looks the map up through Map
+        self.center = None
+        self.update(position)
+
+    @classmethod
+    def from_binary(cls, filename, chunk_size=32, view_distance=64, cached_chunks=64, position=(0, 0)):
+        """Streams the chunks of a binary map (see write_binary_map) from its memory mapped arrays"""
+        tile_size, arrays = read_binary_map(filename)
+        tiles, floor, ceiling = arrays['tiles'], arrays.get('floor'), arrays.get('ceiling')
+
+        def load_chunk(chunk_x, chunk_y):
+            return tuple(None if array is None else cut_chunk(array, chunk_x, chunk_y, chunk_size)
+                         for array in (tiles, floor, ceiling))
+
+        # saved maps are compact already, so the dtype of the file fits the ids without reading the whole world
+        dtype = np.result_type(*(array for array in (tiles, floor, ceiling) if array is not None))
+        world = cls(load_chunk, chunk_size, view_distance, tile_size, cached_chunks, floor is not None,
+                    ceiling is not None, position, dtype)
+        world.sprites = arrays.get('sprites')
+        return world
+
+    def chunk(self, chunk_x, chunk_y):
+        key = chunk_x, chunk_y
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = self.load_chunk(chunk_x, chunk_y)
+            while len(self.chunks) > self.cached_chunks:
+                self.chunks.popitem(last=False)
+        else:
+            self.chunks.move_to_end(key)
+        return chunk
+
+    def chunk_of(self, position):
+        return (int(position[0] // (self.tile_size * self.chunk_size)),
+                int(position[1] // (self.tile_size * self.chunk_size)))
+
+    def will_update(self, position):
+        return self.chunk_of(position) != self.center
+
+    def update(self, position):
+        """
+        Moves the window to be around position (global), when it moved to another chunk.
+        The arrays are rewritten in place, so nothing may be cast on them meanwhile
+        """
+        center = self.chunk_of(position)
+        if center == self.center:
+            return False
+        self.center = center
+        self.origin = ((center[0] - self.radius) * self.chunk_size, (center[1] - self.radius) * self.chunk_size)
+
+        size = self.chunk_size
+        windows = (self.map(), self.floor_array, self.ceiling_array)
+        for window_x in range(2 * self.radius + 1):
+            for window_y in range(2 * self.radius + 1):
+                chunk = self.chunk(center[0] - self.radius + window_x, center[1] - self.radius + window_y)
+                for window, part in zip(windows, chunk):
+                    if window is not None:
+                        cells = window[window_y * size:(window_y + 1) * size, window_x * size:(window_x + 1) * size]
+                        if part is None:
+                            cells.fill(0)
+                        else:
+                            cells[:] = part
+        if self.distances.size:
+            self.build_distance_field(self.distance_cap)
+        return True
+
+
+def cut_chunk(array, chunk_x, chunk_y, chunk_size):
+    """The chunk_size x chunk_size chunk of array, the part outside of the array is 0"""
+    chunk = np.zeros((chunk_size, chunk_size), array.dtype)
+    height, width = array.shape
+    x0, y0 = chunk_x * chunk_size, chunk_y * chunk_size
+    x1, y1 = min(x0 + chunk_size, width), min(y0 + chunk_size, height)
+    if x0 < width and y0 < height and x1 > 0 and y1 > 0:
+        x0_in, y0_in = max(x0, 0), max(y0, 0)
+        chunk[y0_in - y0:y1 - y0, x0_in - x0:x1 - x0] = array[y0_in:y1, x0_in:x1]
+    return chunk
+
+
+TILE_DTYPES = (np.uint8, np.uint16, np.uint32)  # the kernels are compiled for each (see warm_up)
+
+
+def compact_dtype(*arrays):
+    """The smallest of TILE_DTYPES that holds every id of arrays (None are skipped), int64 if there are negative ids"""
+    arrays = [array for array in arrays if array is not None and array.size]
+    if not arrays:
+        return TILE_DTYPES[0]
+    if min(int(array.min()) for array in arrays) < 0:
+        return np.int64
+    largest = max(int(array.max()) for array in arrays)
+    for dtype in TILE_DTYPES:
+        if largest <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+no_visits = np.zeros((0, 0), np.uint8)  # pass as visited to not record the visited tiles
+no_distances = np.zeros((0, 0), np.uint8)  # pass as distances to step through every tile
+LEAP_DISTANCE = 8  # rays leap from tiles at least this far from walls, shorter leaps cost more than the steps
+
+# Binary map file: MAP_MAGIC, the length of the header (uint32), a JSON header and then the arrays in C order,
+# each at an offset aligned to MAP_ALIGNMENT. The header holds the tile size and the dtype, shape and offset of every
+# array: 'tiles', and optionally 'floor', 'ceiling' and 'sprites' (rows of x, y, texture id)
+MAP_MAGIC = b'RAYMAP01'
+MAP_ALIGNMENT = 64
+
+
+def write_binary_map(filename, tile_size, arrays):
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+    # the offsets are in the header, so the data starts after the first aligned offset the header fits before
+    data_start = 0
+    header = b''
+    while len(MAP_MAGIC) + 4 + len(header) > data_start:
+        data_start += MAP_ALIGNMENT
+        offsets = {}
+        offset = data_start
+        for name, array in arrays.items():
+            offsets[name] = offset
+            offset += -(-array.nbytes // MAP_ALIGNMENT) * MAP_ALIGNMENT
+        header = json.dumps({'tile_size': tile_size, 'arrays': {
+            name: {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offsets[name]}
+            for name, array in arrays.items()
+        }}).encode()
+
+    with open(filename, 'wb') as file:
+        file.write(MAP_MAGIC)
+        file.write(len(header).to_bytes(4, 'little'))
+        file.write(header)
+        for name, array in arrays.items():
+            file.seek(offsets[name])
+            file.write(array.tobytes())
+
+
+def read_binary_map(filename):
+    """Returns the tile size and the arrays of a binary map, memory mapped copy on write"""
+    with open(filename, 'rb') as file:
+        if file.read(len(MAP_MAGIC)) != MAP_MAGIC:
+            raise ValueError('Not a binary map file', filename)
+        header = json.loads(file.read(int.from_bytes(file.read(4), 'little')))
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        if 0 in entry['shape']:  # can't map an empty array
+            arrays[name] = np.zeros(entry['shape'], entry['dtype'])
+        else:
+            # np.asarray drops the memmap subclass, the pages are still read lazily
+            arrays[name] = np.asarray(np.memmap(filename, entry['dtype'], 'c', entry['offset'], tuple(entry['shape'])))
+    return header['tile_size'], arrays
 
 
-@njit(nogil=True, fastmath=True)
-def cast_ray(array, start_x, start_y, direction_x, direction_y, widths):
+def convert_text_map(map_file, binary_file, floor_file=None, ceiling_file=None, sprites_file=None,
+                     tile_size=Map.TILE_SIZE):
+    """
+    Converts a text map (and its floor and ceiling text maps) to a binary map. sprites_file is a JSON list of
+    [[x, y], texture id] like Assets/MapsFiles/sprites_map.pickle
+    """
+    arrays = {'tiles': Map.load_file(map_file)}
+    if floor_file is not None:
+        arrays['floor'] = Map.load_file(floor_file)
+    if ceiling_file is not None:
+        arrays['ceiling'] = Map.load_file(ceiling_file)
+    dtype = compact_dtype(*arrays.values())  # the dtype Map would use, so from_binary doesn't convert them
+    arrays = {name: array.astype(dtype) for name, array in arrays.items()}
+    if sprites_file is not None:
+        with open(sprites_file) as file:
+            sprites = json.load(file)
+        arrays['sprites'] = np.array([(x, y, int(id_)) for (x, y), id_ in sprites], np.int64).reshape(-1, 3)
+    write_binary_map(binary_file, tile_size, arrays)
+
+
+@njit(nogil=True, fastmath=True, cache=True)
+def cast_ray(array, start_x, start_y, direction_x, direction_y, widths, visited, distances):
     """
     Cast a ray from start_pos in the direction of the unit vector direction
-    and returns it's length
+    and returns it's length.
+    Every tile the ray passes through (including the one it hits) is set to 1 in visited (an array the shape of
+    array), unless it is empty (no_visits)
+    With a distance field (see Map.build_distance_field, no_distances for none) the ray leaps across empty space,
+    but only when it doesn't record the visited tiles
     """
     height, width = array.shape
+    record = visited.shape[0] > 0
+    skip = distances.shape[0] > 0 and not record
+    reach = max(abs(direction_x), abs(direction_y))  # tiles the ray moves on its faster axis per unit of length
 
-    step_x = abs(1 / direction_x) if direction_x != 0 else np.Inf
-    step_y = abs(1 / direction_y) if direction_y != 0 else np.Inf
+    step_x = abs(1 / direction_x) if direction_x != 0 else np.inf
+    step_y = abs(1 / direction_y) if direction_y != 0 else np.inf
 
     # optimisation from:
     # step_size = structures.Vector2.Cartesian(
@@ -137,6 +484,9 @@ def cast_ray(array, start_x, start_y, direction_x, direction_y, widths):
         ray_length_y += (start_y - map_y) * step_y
         step_dir_y = -1
 
+    if record and 0 <= map_x < width and 0 <= map_y < height:
+        visited[map_y, map_x] = 1
+
     tile_found = 0
     while not tile_found:
         if ray_length_x < ray_length_y:
@@ -148,8 +498,24 @@ def cast_ray(array, start_x, start_y, direction_x, direction_y, widths):
             ray_length_y += step_y
             side = False
         if 0 <= map_x < width and 0 <= map_y < height:
+            if record:
+                visited[map_y, map_x] = 1
             if array[map_y, map_x] != 0:
                 tile_found = array[map_y, map_x]
+            elif skip and distances[map_y, map_x] >= LEAP_DISTANCE:
+                # every tile closer than distance is empty and inside the map, so the ray can go on until it moved
+                # (distance - 2) tiles past the next tile border on either axis, and cross all the borders before it
+                # at once. The direction isn't always a unit vector (screen rays), so that is measured on its larger
+                # component
+                target = min(ray_length_x, ray_length_y) + (distances[map_y, map_x] - 2) / reach
+                if ray_length_x <= target:
+                    steps = int((target - ray_length_x) / step_x) + 1
+                    map_x += steps * step_dir_x
+                    ray_length_x += steps * step_x
+                if ray_length_y <= target:
+                    steps = int((target - ray_length_y) / step_y) + 1
+                    map_y += steps * step_dir_y
+                    ray_length_y += steps * step_y
         else:
             break
 
@@ -182,49 +548,311 @@ def cast_ray(array, start_x, start_y, direction_x, direction_y, widths):
 empty = np.empty(0, np.float64)
 
 
-@njit(nogil=True)
+@njit(nogil=True, fastmath=True, cache=True)
+def project_column(x, W, array, pos_x, pos_y, dir_x, camera_x, dir_y, camera_y, H, inv_height, tilt, tex_widths,
+                   tex_heights, walls_ratio, visited, distances):
+    """
+    Casts the ray of screen column x and projects the wall it hits to the screen.
+    Returns length, col_start, col_height, y_start, y_height, shade, tex_x, tile_id (length is 0 when nothing is hit)
+    """
+    pixel_camera_pos = 2 * x / W - 1  # Turns the screen to coordinates from -1 to 1
+    length, side, texX, tile_id = cast_ray(array, pos_x, pos_y, dir_x + camera_x * pixel_camera_pos,
+                                           dir_y + camera_y * pixel_camera_pos, tex_widths, visited, distances)
+    if length == 0:
+        return length, 0, 0, 0, 0, 0, 0, 0
+    line_height = walls_ratio * H / length
+
+    draw_start = - inv_height * line_height / 2 + H / 2 + tilt
+
+    c = max(1, int((255.0 - length * 5) * (1 - side * 0.25)))  # length coefficient
+    # measures how distance affect brightness. Side coefficient measures how sunlight affects the brightness (.25)
+    # seems to be the right choice
+
+    draw_end = draw_start + line_height
+
+    tex_height = tex_heights[tile_id]
+    y_start = max(-tex_height, draw_start)
+    y_stop = min(H + tex_height, draw_end)
+    pixels_per_texel = line_height / tex_height
+    col_start = int((y_start - draw_start) / pixels_per_texel + .5)
+    col_height = int((y_stop - y_start) / pixels_per_texel + .5)
+
+    y_start = int(col_start * pixels_per_texel + draw_start + .5)
+    y_height = int(col_height * pixels_per_texel + .5)
+
+    return length, col_start, col_height, y_start, y_height, c, texX, tile_id
+
+
+@njit(nogil=True, cache=True)
 def cast_screen(W, resolution, array, pos_x, pos_y, dir_x, camera_x, dir_y, camera_y, H, tilt, height, tex_widths,
                 tex_heights, walls_ratio=1):
     """Casts really really fast, but it takes another iteration to draw the lines so it is not efficient"""
     z_buffer = np.zeros(W, np.float64)
+    visited = np.zeros((0, 0), np.uint8)  # not recorded
+    distances = np.zeros((0, 0), np.uint8)
+    inv_height = 2 - height
+
+    for x in range(0, W, resolution):
+        length, col_start, col_height, y_start, y_height, c, texX, tile_id = project_column(
+            x, W, array, pos_x, pos_y, dir_x, camera_x, dir_y, camera_y, H, inv_height, tilt, tex_widths,
+            tex_heights, walls_ratio, visited, distances)
+        if length == 0:
+            continue
+
+        z_buffer[x] = length
+
+        yield x, col_start, col_height, y_start, y_height, c, texX, empty, tile_id
+
+    yield -1, 0, 0, 0, 0, 0, 0, z_buffer, 0
+
+
+@njit(nogil=True, fastmath=True, cache=True)
+def mip_level(texels_per_pixel, levels):
+    """
+    The mip level to sample when one pixel covers texels_per_pixel texels of level 0. BillboardSprite.draw_sprite has
+    a copy of it, keep them the same
+    """
+    level = 0
+    while texels_per_pixel >= 2 and level < levels - 1:
+        texels_per_pixel /= 2
+        level += 1
+    return level
+
+
+@njit(nogil=True, fastmath=True, cache=True)
+def draw_column(frame, texture, mip_offsets, tex_width, tex_height, level, x, resolution, col_start, col_height,
+                y_start, y_height, shade, tex_x):
+    """
+    Draws one wall column into frame (a (W, H, 3) pixels array), the same as scaling the texture stripe
+    (tex_x, col_start, 1, col_height) to (resolution, y_height), multiplying it by shade and blitting it at
+    (x, y_start). The texels are sampled from the given mip level of texture (see pg_structures.pack_mip_atlas)
+    """
+    W, H = frame.shape[0], frame.shape[1]
+    x_stop = min(x + resolution, W)
+    y_from = max(y_start, 0)
+    y_to = min(y_start + y_height, H)
+    level_width = max(1, tex_width >> level)
+    level_height = max(1, tex_height >> level)
+    level_x = mip_offsets[level] + min(tex_x >> level, level_width - 1)
+    for y in range(y_from, y_to):
+        tex_y = col_start + (y - y_start) * col_height // y_height  # nearest neighbour, like transform.scale
+        if tex_y >= tex_height:
+            tex_y = tex_height - 1
+        tex_y = min(tex_y >> level, level_height - 1)
+        for channel in range(3):
+            value = (texture[level_x, tex_y, channel] * shade + 255) >> 8  # same as BLEND_MULT
+            for column in range(x, x_stop):
+                frame[column, y, channel] = value
+
+
+COLUMN_DTYPE = np.dtype([
+    ('x', np.int64),
+    ('col_start', np.int64),
+    ('col_height', np.int64),
+    ('y_start', np.int64),
+    ('y_height', np.int64),
+    ('shade', np.int64),
+    ('tex_x', np.int64),
+    ('tile_id', np.int64),
+    ('z', np.float64),
+])
+
+
+def allocate_columns(W, resolution):
+    """Allocates the columns array cast_screen_batch fills, can be reused every frame with the same W and resolution"""
+    return np.zeros(len(range(0, W, resolution)), COLUMN_DTYPE)
+
+
+@njit(nogil=True, cache=True)
+def cast_screen_batch(columns, z_buffer, visited, distances, W, resolution, array, pos_x, pos_y, dir_x, camera_x,
+                      dir_y, camera_y, H, tilt, height, tex_widths, tex_heights, walls_ratio=1):
+    """
+    Same as cast_screen, but fills the caller-owned columns (see allocate_columns) and z_buffer arrays in one call
+    instead of yielding every column. Returns the amount of columns filled (columns that hit nothing are left out).
+    The tiles the rays pass through are set to 1 in visited (all others to 0), pass no_visits to skip it.
+    distances is the map's distance field (see cast_ray), or no_distances
+    """
+    z_buffer[:] = 0
+    visited[:] = 0
     inv_height = 2 - height
 
+    count = 0
     for x in range(0, W, resolution):
-        pixel_camera_pos = 2 * x / W - 1  # Turns the screen to coordinates from -1 to 1
-        length, side, texX, tile_id = cast_ray(array, pos_x, pos_y, dir_x + camera_x * pixel_camera_pos,
-                                               dir_y + camera_y * pixel_camera_pos, tex_widths)
+        length, col_start, col_height, y_start, y_height, c, texX, tile_id = project_column(
+            x, W, array, pos_x, pos_y, dir_x, camera_x, dir_y, camera_y, H, inv_height, tilt, tex_widths,
+            tex_heights, walls_ratio, visited, distances)
         if length == 0:
             continue
-        line_height = walls_ratio * H / length
 
-        draw_start = - inv_height * line_height / 2 + H / 2 + tilt
+        z_buffer[x] = length
+
+        column = columns[count]
+        column.x = x
+        column.col_start = col_start
+        column.col_height = col_height
+        column.y_start = y_start
+        column.y_height = y_height
+        column.shade = c
+        column.tex_x = texX
+        column.tile_id = tile_id
+        column.z = length
+        count += 1
 
-        c = max(1, int((255.0 - length * 5) * (1 - side * 0.25)))  # length coefficient
-        # measures how distance affect brightness. Side coefficient measures how sunlight affects the brightness (.25)
-        # seems to be the right choice
+    return count
 
-        draw_end = draw_start + line_height
 
-        tex_height = tex_heights[tile_id]
-        y_start = max(-tex_height, draw_start)
-        y_stop = min(H + tex_height, draw_end)
-        pixels_per_texel = line_height / tex_height
-        col_start = int((y_start - draw_start) / pixels_per_texel + .5)
-        col_height = int((y_stop - y_start) / pixels_per_texel + .5)
+@njit(nogil=True, parallel=True, cache=True)
+def cast_screen_parallel(columns, z_buffer, visited, distances, W, resolution, array, pos_x, pos_y, dir_x, camera_x,
+                         dir_y, camera_y, H, tilt, height, tex_widths, tex_heights, walls_ratio=1):
+    """
+    Same as cast_screen_batch, but the columns are split across the numba threads (see numba.set_num_threads).
+    Every column keeps its own slot (columns[x // resolution]) so columns that hit nothing are not left out but
+    get tile_id 0. Returns the amount of columns filled
+    """
+    z_buffer[:] = 0
+    visited[:] = 0
+    inv_height = 2 - height
 
-        y_start = int(col_start * pixels_per_texel + draw_start + .5)
-        y_height = int(col_height * pixels_per_texel + .5)
+    count = (W + resolution - 1) // resolution
+    for i in prange(count):
+        x = i * resolution
+        length, col_start, col_height, y_start, y_height, c, texX, tile_id = project_column(
+            x, W, array, pos_x, pos_y, dir_x, camera_x, dir_y, camera_y, H, inv_height, tilt, tex_widths,
+            tex_heights, walls_ratio, visited, distances)
 
         z_buffer[x] = length
 
-        yield x, col_start, col_height, y_start, y_height, c, texX, empty, tile_id
+        column = columns[i]
+        column.x = x
+        column.col_start = col_start
+        column.col_height = col_height
+        column.y_start = y_start
+        column.y_height = y_height
+        column.shade = c
+        column.tex_x = texX
+        column.tile_id = tile_id
+        column.z = length
+
+    return count
+
+
+@njit(nogil=True, cache=True)
+def draw_wall_columns(frame, atlas, tex_widths, tex_heights, mip_offsets, columns, count, resolution):
+    """Draws the first count columns filled by cast_screen_batch into frame (a (W, H, 3) pixels array)"""
+    for i in range(count):
+        column = columns[i]
+        tile_id = column.tile_id
+        if tile_id == 0:
+            continue
+        if column.col_height > 0 and column.col_start < tex_heights[tile_id] and column.y_height > 0:
+            level = mip_level(column.col_height / column.y_height, mip_offsets.shape[1])
+            draw_column(frame, atlas[tile_id], mip_offsets[tile_id], tex_widths[tile_id], tex_heights[tile_id], level,
+                        column.x, resolution, column.col_start, column.col_height, column.y_start, column.y_height,
+                        column.shade, column.tex_x)
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def draw_wall_columns_parallel(frame, atlas, tex_widths, tex_heights, mip_offsets, columns, count,
+                               resolution):
+    """Same as draw_wall_columns, split across the numba threads (every column owns its own pixels)"""
+    for i in prange(count):
+        column = columns[i]
+        tile_id = column.tile_id
+        if tile_id == 0:
+            continue
+        if column.col_height > 0 and column.col_start < tex_heights[tile_id] and column.y_height > 0:
+            level = mip_level(column.col_height / column.y_height, mip_offsets.shape[1])
+            draw_column(frame, atlas[tile_id], mip_offsets[tile_id], tex_widths[tile_id], tex_heights[tile_id], level,
+                        column.x, resolution, column.col_start, column.col_height, column.y_start, column.y_height,
+                        column.shade, column.tex_x)
 
-    yield -1, 0, 0, 0, 0, 0, 0, z_buffer, 0
+
+@njit(nogil=True, cache=True)
+def draw_walls(frame, atlas, W, resolution, array, pos_x, pos_y, dir_x, camera_x, dir_y, camera_y, H, tilt, height,
+               tex_widths, tex_heights, mip_offsets, walls_ratio=1):
+    """
+    Casts the whole screen and draws the walls straight into frame (a (W, H, 3) pixels array) using the packed
+    texture atlas (see pg_structures.Texture.pack_atlas). Returns the z buffer
+    """
+    columns = np.zeros((W + resolution - 1) // resolution, COLUMN_DTYPE)
+    z_buffer = np.zeros(W, np.float64)
+    visited = np.zeros((0, 0), np.uint8)  # not recorded
+    distances = np.zeros((0, 0), np.uint8)
+    count = cast_screen_batch(columns, z_buffer, visited, distances, W, resolution, array, pos_x, pos_y, dir_x,
+                              camera_x, dir_y, camera_y, H, tilt, height, tex_widths, tex_heights, walls_ratio)
+    draw_wall_columns(frame, atlas, tex_widths, tex_heights, mip_offsets, columns, count, resolution)
+    return z_buffer
 
 
-@njit(nogil=True)
-def cast_floor_ceiling(dir_x, dir_y, camera_x, camera_y, W, H, pos_x, pos_y, textures_array, texture_map,
-                       h, vertical_angle, is_floor):
+@njit(nogil=True, fastmath=True, cache=True)
+def floor_ceiling_row(buffer, y, dir_x, dir_y, camera_x, camera_y, W, H, pos_x, pos_y, textures_array, texture_widths,
+                      texture_heights, mip_offsets, texture_map, h, is_floor):
+    """
+    Casts the scanline y of the floor (or ceiling) into buffer, h should already be flipped for the ceiling.
+    The textures are sampled from the mip level that fits the distance of the row (see pg_structures.pack_mip_atlas)
+    """
+    height = H // 2
+    map_width, map_height = texture_map.shape
+
+    # rayDir for leftmost ray (x = 0) and rightmost ray (x = w)
+    ray_dir_x0 = dir_x - camera_x
+    ray_dir_y0 = dir_y - camera_y
+    ray_dir_x1 = dir_x + camera_x
+    ray_dir_y1 = dir_y + camera_y
+
+    # Current y position compared to the center of the screen (the horizon)
+    p = y - H // 2
+
+    # Vertical position of the camera.
+    pos_z = H * h / 2
+
+    # Horizontal distance from the camera to the floor for the current row.
+    # 0.5 is the z position exactly in the middle between floor and ceiling.
+    row_distance = pos_z / p
+
+    # calculate the real world step vector we have to add for each x (parallel to camera plane)
+    # adding step by step avoids multiplications with a weight in the inner loop
+    floor_step_x = row_distance * (ray_dir_x1 - ray_dir_x0) / W
+    floor_step_y = row_distance * (ray_dir_y1 - ray_dir_y0) / W
+
+    # real world coordinates of the leftmost column. This will be updated as we step to the right.
+    floor_x = pos_x + row_distance * ray_dir_x0
+    floor_y = pos_y + row_distance * ray_dir_y0
+
+    # how many tiles one pixel of this row covers
+    tiles_per_pixel = math.sqrt(floor_step_x * floor_step_x + floor_step_y * floor_step_y)
+    levels = mip_offsets.shape[1]
+
+    for x in range(W):
+        cell_x = int(floor_x)
+        cell_y = int(floor_y)
+
+        if 0 <= cell_x < map_height and 0 <= cell_y < map_width:
+            texture_id = texture_map[cell_y, cell_x]
+        else:
+            texture_id = 0
+        text_width = texture_widths[texture_id]
+        level = mip_level(tiles_per_pixel * text_width, levels)
+        level_width = max(1, text_width >> level)
+        level_height = max(1, texture_heights[texture_id] >> level)
+
+        tx = int(level_width * (floor_x - cell_x))
+        ty = int(level_height * (floor_y - cell_y))
+
+        floor_x += floor_step_x
+        floor_y += floor_step_y
+
+        color = textures_array[texture_id, mip_offsets[texture_id, level] + tx, ty]
+
+        if is_floor:
+            buffer[x, y - height] = color
+        else:
+            buffer[x, height - y - 1] = color
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def cast_floor_ceiling(dir_x, dir_y, camera_x, camera_y, W, H, pos_x, pos_y, textures_array, texture_widths,
+                       texture_heights, mip_offsets, texture_map, h, vertical_angle, is_floor):
     # negative vertical_angle means down!
     if is_floor:
         vertical_angle = - vertical_angle  # needs to draw more when looking down and less if looking down
@@ -232,65 +860,102 @@ def cast_floor_ceiling(dir_x, dir_y, camera_x, camera_y, W, H, pos_x, pos_y, tex
         h = 2 - h
 
     height = H // 2
-    map_width, map_height = texture_map.shape
     buffer = np.zeros((W, max(height + vertical_angle, 0)), np.int8)
-    for y in range(H // 2 + 1, H + vertical_angle):
-        # rayDir for leftmost ray (x = 0) and rightmost ray (x = w)
-        ray_dir_x0 = dir_x - camera_x
-        ray_dir_y0 = dir_y - camera_y
-        ray_dir_x1 = dir_x + camera_x
-        ray_dir_y1 = dir_y + camera_y
-
-        # Current y position compared to the center of the screen (the horizon)
-        p = y - H // 2
-
-        # Vertical position of the camera.
-        pos_z = H * h / 2
-
-        # Horizontal distance from the camera to the floor for the current row.
-        # 0.5 is the z position exactly in the middle between floor and ceiling.
-        row_distance = pos_z / p
-
-        # calculate the real world step vector we have to add for each x (parallel to camera plane)
-        # adding step by step avoids multiplications with a weight in the inner loop
-        floor_step_x = row_distance * (ray_dir_x1 - ray_dir_x0) / W
-        floor_step_y = row_distance * (ray_dir_y1 - ray_dir_y0) / W
-
-        # real world coordinates of the leftmost column. This will be updated as we step to the right.
-        floor_x = pos_x + row_distance * ray_dir_x0
-        floor_y = pos_y + row_distance * ray_dir_y0
-
-        for x in range(W):
-            cell_x = int(floor_x)
-            cell_y = int(floor_y)
-
-            if 0 <= cell_x < map_height and 0 <= cell_y < map_width:
-                text = textures_array[texture_map[cell_y, cell_x]]
-            else:
-                text = textures_array[0]
-            text_width, text_height = text.shape
+    first = H // 2 + 1
+    for y in prange(first, H + vertical_angle):  # every scanline is independent
+        floor_ceiling_row(buffer, y, dir_x, dir_y, camera_x, camera_y, W, H, pos_x, pos_y, textures_array,
+                          texture_widths, texture_heights, mip_offsets, texture_map, h, is_floor)
+    return buffer
 
-            tx = int(text_width * (floor_x - cell_x))
-            ty = int(text_height * (floor_y - cell_y))
 
-            floor_x += floor_step_x
-            floor_y += floor_step_y
+@njit(nogil=True, parallel=True, cache=True)
+def cast_floor_and_ceiling(dir_x, dir_y, camera_x, camera_y, W, H, pos_x, pos_y, floor_textures, floor_widths,
+                           floor_heights, floor_offsets, floor_map, ceiling_textures, ceiling_widths, ceiling_heights,
+                           ceiling_offsets, ceiling_map, h, vertical_angle):
+    """
+    Same as calling cast_floor_ceiling for the floor and for the ceiling, but the scanlines of both are split across
+    the numba threads in one call. Returns the floor and ceiling buffers
+    """
+    # negative vertical_angle means down!
+    height = H // 2
+    floor = np.zeros((W, max(height - vertical_angle, 0)), np.int8)
+    ceiling = np.zeros((W, max(height + vertical_angle, 0)), np.int8)
+
+    first = H // 2 + 1
+    floor_rows = max(H - vertical_angle - first, 0)
+    ceiling_rows = max(H + vertical_angle - first, 0)
+    for i in prange(floor_rows + ceiling_rows):
+        if i < floor_rows:
+            floor_ceiling_row(floor, first + i, dir_x, dir_y, camera_x, camera_y, W, H, pos_x, pos_y,
+                              floor_textures, floor_widths, floor_heights, floor_offsets, floor_map, h, True)
+        else:
+            floor_ceiling_row(ceiling, first + i - floor_rows, dir_x, dir_y, camera_x, camera_y, W, H, pos_x, pos_y,
+                              ceiling_textures, ceiling_widths, ceiling_heights, ceiling_offsets, ceiling_map, 2 - h,
+                              False)
+    return floor, ceiling
 
-            # print('before:', format(color, '032b'))
-            # color <<= 1
-            # print('after:', format(color, '032b'))
-            # color = (color >> 1) & 8355711
-            # print(row_distance)
-            color = text[tx, ty]
 
-            if is_floor:
-                buffer[x, y - height] = color
-            else:
-                buffer[x, height - y - 1] = color
-    return buffer
+@njit(nogil=True, fastmath=True, cache=True)
+def floor_ceiling_row_big_texture(buffer, y, dir_x, dir_y, camera_x, camera_y, W, H, pos_x, pos_y, big_texture,
+                                  tile_size, default_texture, h, is_floor):
+    """Casts the scanline y of a floor (or ceiling) that is textured by one big texture into buffer"""
+    height = H // 2
+    map_width, map_height = big_texture.shape
+    map_width //= tile_size
+    map_height //= tile_size
+
+    # rayDir for leftmost ray (x = 0) and rightmost ray (x = w)
+    ray_dir_x0 = dir_x - camera_x
+    ray_dir_y0 = dir_y - camera_y
+    ray_dir_x1 = dir_x + camera_x
+    ray_dir_y1 = dir_y + camera_y
+
+    # Current y position compared to the center of the screen (the horizon)
+    p = y - H // 2
+
+    # Vertical position of the camera.
+    pos_z = H * h / 2
+
+    # Horizontal distance from the camera to the floor for the current row.
+    # 0.5 is the z position exactly in the middle between floor and ceiling.
+    row_distance = pos_z / p
+
+    # calculate the real world step vector we have to add for each x (parallel to camera plane)
+    # adding step by step avoids multiplications with a weight in the inner loop
+    floor_step_x = row_distance * (ray_dir_x1 - ray_dir_x0) / W
+    floor_step_y = row_distance * (ray_dir_y1 - ray_dir_y0) / W
+
+    # real world coordinates of the leftmost column. This will be updated as we step to the right.
+    floor_x = pos_x + row_distance * ray_dir_x0
+    floor_y = pos_y + row_distance * ray_dir_y0
+
+    for x in range(W):
+        cell_x = int(floor_x)
+        cell_y = int(floor_y)
 
+        if 0 <= cell_x < map_width and 0 <= cell_y < map_height:
+            text = big_texture[
+                   cell_x * tile_size:(cell_x+1) * tile_size,
+                   cell_y * tile_size:(cell_y+1) * tile_size,
+                   ]
+        else:
+            text = default_texture
+
+        tx = int(tile_size * (floor_x - cell_x))
+        ty = int(tile_size * (floor_y - cell_y))
+
+        floor_x += floor_step_x
+        floor_y += floor_step_y
+
+        color = text[tx, ty]
 
-@njit(nogil=True)
+        if is_floor:
+            buffer[x, y - height] = color
+        else:
+            buffer[x, height - y - 1] = color
+
+
+@njit(nogil=True, parallel=True, cache=True)
 def cast_floor_ceiling_big_texture(dir_x, dir_y, camera_x, camera_y, W, H, pos_x, pos_y, big_texture, tile_size,
                                    default_texture,
                        h, vertical_angle, is_floor):
@@ -301,90 +966,187 @@ def cast_floor_ceiling_big_texture(dir_x, dir_y, camera_x, camera_y, W, H, pos_x
         h = 2 - h
 
     height = H // 2
-    map_width, map_height = big_texture.shape
-    map_width //= tile_size
-    map_height //= tile_size
     buffer = np.zeros((W, max(height + vertical_angle, 0)), np.int8)
-    for y in range(H // 2 + 1, H + vertical_angle):
-        # rayDir for leftmost ray (x = 0) and rightmost ray (x = w)
-        ray_dir_x0 = dir_x - camera_x
-        ray_dir_y0 = dir_y - camera_y
-        ray_dir_x1 = dir_x + camera_x
-        ray_dir_y1 = dir_y + camera_y
-
-        # Current y position compared to the center of the screen (the horizon)
-        p = y - H // 2
-
-        # Vertical position of the camera.
-        pos_z = H * h / 2
-
-        # Horizontal distance from the camera to the floor for the current row.
-        # 0.5 is the z position exactly in the middle between floor and ceiling.
-        row_distance = pos_z / p
-
-        # calculate the real world step vector we have to add for each x (parallel to camera plane)
-        # adding step by step avoids multiplications with a weight in the inner loop
-        floor_step_x = row_distance * (ray_dir_x1 - ray_dir_x0) / W
-        floor_step_y = row_distance * (ray_dir_y1 - ray_dir_y0) / W
-
-        # real world coordinates of the leftmost column. This will be updated as we step to the right.
-        floor_x = pos_x + row_distance * ray_dir_x0
-        floor_y = pos_y + row_distance * ray_dir_y0
-
-        for x in range(W):
-            cell_x = int(floor_x)
-            cell_y = int(floor_y)
-
-            if 0 <= cell_x < map_width and 0 <= cell_y < map_height:
-                text = big_texture[
-                       cell_x * tile_size:(cell_x+1) * tile_size,
-                       cell_y * tile_size:(cell_y+1) * tile_size,
-                       ]
-            else:
-                text = default_texture
+    first = H // 2 + 1
+    for y in prange(first, H + vertical_angle):  # every scanline is independent
+        floor_ceiling_row_big_texture(buffer, y, dir_x, dir_y, camera_x, camera_y, W, H, pos_x, pos_y, big_texture,
+                                      tile_size, default_texture, h, is_floor)
+    return buffer
 
-            tx = int(tile_size * (floor_x - cell_x))
-            ty = int(tile_size * (floor_y - cell_y))
 
-            floor_x += floor_step_x
-            floor_y += floor_step_y
+WALL_MARGIN = 0.000001  # distance kept between a box pushed out of a wall and the wall
 
-            # print('before:', format(color, '032b'))
-            # color <<= 1
-            # print('after:', format(color, '032b'))
-            # color = (color >> 1) & 8355711
-            # print(row_distance)
-            color = text[tx, ty]
 
-            if is_floor:
-                buffer[x, y - height] = color
+@njit(nogil=True, cache=True)
+def box_tile_hit(array, tile_size, x, y, half_width, half_height):
+    """
+    Returns the coordinates of the first wall tile under a corner of the box centered at (x, y) (global), checking the
+    corners in the order (-w, +h), (+w, +h), (+w, -h), (-w, -h). Outside of the map counts as empty. (-1, -1) if none
+    """
+    height, width = array.shape
+    for corner in range(4):  # (-w, +h), (+w, +h), (+w, -h), (-w, -h)
+        corner_x = x + half_width if corner == 1 or corner == 2 else x - half_width
+        corner_y = y + half_height if corner < 2 else y - half_height
+        tile_x = int(math.floor(corner_x / tile_size))
+        tile_y = int(math.floor(corner_y / tile_size))
+        if 0 <= tile_x < width and 0 <= tile_y < height and array[tile_y, tile_x] != 0:
+            return tile_x, tile_y
+    return -1, -1
+
+
+@njit(nogil=True, cache=True)
+def resolve_box(array, tile_size, x, y, half_width, half_height, displacement, axis):
+    """
+    Resolves the box centered at (x, y) that moved by displacement on axis (0 for x, 1 for y) against the walls.
+    Returns its corrected coordinate on that axis, moved back to the edge of the wall it hit
+    """
+    tile_x, tile_y = box_tile_hit(array, tile_size, x, y, half_width, half_height)
+    if axis == 0:
+        if tile_x < 0:
+            return x
+        if displacement > 0:  # moved right, move it back left
+            return tile_x * tile_size - half_width - WALL_MARGIN
+        return (tile_x + 1) * tile_size + half_width + WALL_MARGIN
+    if tile_y < 0:
+        return y
+    if displacement > 0:  # moved down, move it back up
+        return tile_y * tile_size - half_height - WALL_MARGIN
+    return (tile_y + 1) * tile_size + half_height + WALL_MARGIN
+
+
+@njit(nogil=True, cache=True)
+def resolve_boxes(array, tile_size, positions, half_sizes, displacements, axis):
+    """resolve_box for every box, positions (n, 2) are corrected in place"""
+    for i in range(positions.shape[0]):
+        positions[i, axis] = resolve_box(array, tile_size, positions[i, 0], positions[i, 1], half_sizes[i, 0],
+                                         half_sizes[i, 1], displacements[i], axis)
+
+
+@njit(nogil=True, cache=True)
+def chebyshev_distances(array, distances, x0, y0, x1, y1, cap):
+    """
+    Sets distances[y0:y1, x0:x1] to the Chebyshev distance (at most cap) of the tiles to the nearest wall or to the
+    edge of array (walls are 0, tiles on the edge 1). Only the tiles within cap of that part are read, so a part
+    around a changed tile is enough to update the distances
+    """
+    height, width = array.shape
+    left, top = max(x0 - cap, 0), max(y0 - cap, 0)
+    right, bottom = min(x1 + cap, width), min(y1 + cap, height)
+    scratch = np.empty((bottom - top, right - left), np.int64)
+    for y in range(top, bottom):
+        for x in range(left, right):
+            if array[y, x] != 0:
+                scratch[y - top, x - left] = 0
+            elif x == 0 or y == 0 or x == width - 1 or y == height - 1:
+                scratch[y - top, x - left] = 1
             else:
-                buffer[x, height - y - 1] = color
-    return buffer
+                scratch[y - top, x - left] = cap
+
+    # two passes over the 8 neighbours, exact for the Chebyshev distance
+    rows, columns = scratch.shape
+    for y in range(rows):
+        for x in range(columns):
+            distance = scratch[y, x]
+            if x > 0:
+                distance = min(distance, scratch[y, x - 1] + 1)
+            if y > 0:
+                distance = min(distance, scratch[y - 1, x] + 1)
+                if x > 0:
+                    distance = min(distance, scratch[y - 1, x - 1] + 1)
+                if x < columns - 1:
+                    distance = min(distance, scratch[y - 1, x + 1] + 1)
+            scratch[y, x] = distance
+    for y in range(rows - 1, -1, -1):
+        for x in range(columns - 1, -1, -1):
+            distance = scratch[y, x]
+            if x < columns - 1:
+                distance = min(distance, scratch[y, x + 1] + 1)
+            if y < rows - 1:
+                distance = min(distance, scratch[y + 1, x] + 1)
+                if x < columns - 1:
+                    distance = min(distance, scratch[y + 1, x + 1] + 1)
+                if x > 0:
+                    distance = min(distance, scratch[y + 1, x - 1] + 1)
+            scratch[y, x] = distance
+
+    for y in range(y0, y1):
+        for x in range(x0, x1):
+            distances[y, x] = min(scratch[y - top, x - left], cap)
+
+
+def pixels_like(W, H):
+    """An empty (W, H, 3) frame laid out like pygame.surfarray.pixels3d of a 32 bit surface (not contiguous)"""
+    return np.zeros((H, W, 4), np.uint8).transpose(1, 0, 2)[:, :, :3]
+
+
+TILT_HEIGHT_TYPES = tuple(itertools.product((int, float), repeat=2))  # every mix of the viewer's tilt and height
+
+
+def warm_up(dtype=None, tilt_height_types=TILT_HEIGHT_TYPES):
+    """
+    Compiles (or loads from numba's on disk cache) every kernel for the argument types the renderer passes, so no code
+    path stalls the first time it is hit: the map arrays of dtype (every dtype Map may pick if None) and the types of
+    the viewer's tilt and height in tilt_height_types, (type of tilt, type of height) pairs. They start as ints and each
+    becomes a float on its own as the viewer moves, the default compiles every mix
+    """
+    for dtype in (TILE_DTYPES + (np.int64,) if dtype is None else (dtype,)):
+        warm_up_tiles(dtype, tilt_height_types)
+
+
+def warm_up_tiles(dtype, tilt_height_types=TILT_HEIGHT_TYPES):
+    """warm_up for map arrays of dtype"""
+    W, H = 8, 6
+    tiles = np.ones((3, 3), dtype)
+    tiles[1, 1] = 0
+    sizes = np.full(2, 4, np.int64)
+    offsets = np.array([[0, 4, 6], [0, 4, 6]], np.int64)  # levels of 4, 2 and 1 texels side by side
+    rgb_atlas = np.zeros((2, 7, 4, 3), np.uint8)
+    indexed_atlas = np.zeros((2, 7, 4), np.uint8)
+    big_texture = np.zeros((12, 12), np.uint8)
+    default_texture = np.zeros((4, 4), np.uint8)
+    frame = pixels_like(W, H)
+    visited = np.zeros(tiles.shape, np.uint8)
+    columns = allocate_columns(W, 1)
+    z_buffer = np.zeros(W, np.float64)
+    view = (1.5, 1.5, 1.0, 0.0, 0.0, 0.66)  # pos_x, pos_y, dir_x, camera_x, dir_y, camera_y
+
+    distances = np.zeros(tiles.shape, np.uint8)
+    chebyshev_distances(tiles, distances, 0, 0, 3, 3, 3)
+    cast_ray(tiles, 1.5, 1.5, 1.0, 0.0, sizes, no_visits, distances)
+    for tilt_type, height_type in tilt_height_types:
+        tilt, height = tilt_type(1), height_type(1)
+        screen = (W, 1, tiles, *view, H, tilt, height, sizes, sizes)
+        for _ in cast_screen(*screen):
+            pass
+        for cast, draw in ((cast_screen_batch, draw_wall_columns),
+                           (cast_screen_parallel, draw_wall_columns_parallel)):
+            count = cast(columns, z_buffer, visited, distances, *screen)
+            draw(frame, rgb_atlas, sizes, sizes, offsets, columns, count, 1)
+        draw_walls(frame, rgb_atlas, *screen, offsets)
+
+        floor_view = (1.0, 0.0, 0.0, 0.66, W, H, 1.5, 1.5)  # dir_x, dir_y, camera_x, camera_y, W, H, pos_x, pos_y
+        cast_floor_ceiling(*floor_view, indexed_atlas, sizes, sizes, offsets, tiles, height, 0, True)
+        cast_floor_and_ceiling(*floor_view, indexed_atlas, sizes, sizes, offsets, tiles,
+                               indexed_atlas, sizes, sizes, offsets, tiles, height, 0)
+        cast_floor_ceiling_big_texture(*floor_view, big_texture, 4, default_texture, height, 0, True)
+
+    for number in (int, float):
+        position = number(75)
+        resolve_box(tiles, Map.TILE_SIZE, position, position, 5.0, 5.0, 1.0, 0)
+    resolve_boxes(tiles, Map.TILE_SIZE, np.full((1, 2), 75.0), np.full((1, 2), 5.0), np.ones(1), 0)
 
 
 if __name__ == '__main__':
-    import pygame
-    texture = pygame.image.load('Assets/Images/Textures/Blood Wall Dark.png')
-
-    arr = pygame.surfarray.array2d(texture)
-    buffer = cast_floor_ceiling(0.91632, 0.40044, -0.23119, 0.52904, 1920, 1080, 3.10000002, 3.10000002, arr)
-
-    image = pygame.surfarray.make_surface(buffer)
-
-    pygame.image.save(image, 'floor.png')
-#     fast = Map.from_file('map2.txt')
-#
-#     import timeit
-#
-#     l = '''
-# c = cast_screen(1920, 1, fast.map(), 3.10000002, 3.10000002, 0.9297758477079633,
-#                  -0.23906392650695832, 0.36812616454000946, 0.6038034954732037, 1080, -156.0, 1.0)
-# for i in c:
-#     pass
-#     '''
-#     print(1, timeit.timeit(l,
-#                            number=1000,
-#                            globals=globals(),
-#                            setup=l
-#                            ))
+    # quick check of the wall caster, Benchmarks/kernel_benchmark.py benchmarks all the kernels
+    import timeit
+
+    fast = Map.from_file('Assets/Maps/map.txt')
+    tex_sizes = np.full(int(fast.map().max()) + 1, 64, np.int64)
+    columns = allocate_columns(1920, 1)
+    z_buffer = np.zeros(1920, np.float64)
+    visited = np.zeros(fast.shape, np.uint8)
+    args = (columns, z_buffer, visited, no_distances, 1920, 1, fast.map(), 3.5, 3.5, 0.9297758477079633,
+            -0.23906392650695832, 0.36812616454000946, 0.6038034954732037, 1080, 0, 1, tex_sizes, tex_sizes)
+    cast_screen_batch(*args)  # compiles
+    print(f'tiles {fast.dtype}, {fast.memory_saved()} bytes less than int64')
+    print(f'cast_screen_batch: {timeit.timeit(lambda: cast_screen_batch(*args), number=1000):.3f} ms')
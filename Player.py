@@ -20,6 +20,7 @@ class Player(BillboardSprite):
         self.speed = speed
         self.moving_direction = structures.Vector2(0, 0)
         self.looking_direction = structures.Vector2(0.88838, 0.45911)
+        self.turned_direction = structures.Vector2(0, 0)  # reused by set_moving_direction_relative
         self.setup_movement()
 
     def move(self, keys, dt):
@@ -29,14 +30,20 @@ class Player(BillboardSprite):
             if keys[key]:
                 function()
 
-        self.velocity = self.speed * self.moving_direction
+        self.velocity.set_ip(self.moving_direction.x * self.speed, self.moving_direction.y * self.speed)
 
     def set_moving_direction(self, x=None, y=None):
         if self.moving_direction:
-            self.moving_direction = self.moving_direction.normalized()
-        self.moving_direction += structures.Vector2(x or 0, y or 0)
+            self.moving_direction.normalize_ip()
+        self.moving_direction.x += x or 0
+        self.moving_direction.y += y or 0
         if self.moving_direction:
-            self.moving_direction = self.moving_direction.normalized()
+            self.moving_direction.normalize_ip()
+
+    def set_moving_direction_relative(self, matrix):
+        """set_moving_direction to the looking direction rotated by matrix (a RotationMatrix)"""
+        turned = self.turned_direction.set_ip(self.looking_direction.x, self.looking_direction.y).rotate_ip(matrix)
+        self.set_moving_direction(turned.x, turned.y)
 
     def setup_movement(self):
         self.up_down_left_right_movements()
@@ -1,5 +1,8 @@
 import collections
 import json
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 from Player import Player, Weapon
 import pygame
@@ -7,15 +10,34 @@ import FasterMap
 import structures
 import pg_structures
 import numpy as np
-from threading import Thread
-from Sprites3D import BillboardSprite, Sprites, PanoramicSprites
+from Sprites3D import BillboardSprite, Sprites, PanoramicSprites, SpriteStore
 from numba.typed import Dict
 from numba import types
+import numba
+
+
+Camera = collections.namedtuple('Camera', ('position', 'looking_direction', 'tilt', 'vertical_position'))
 
 
 class RenderSettings:
     Fov = 90
     Resolution = 3
+    Threads = 0  # threads used to cast the screen, 0 for all cores and 1 for the serial caster
+    Pipelined = False  # cast the next frame on a worker while the current one is presented
+    # more than 1 draws a frame while the next ones are cast, numba's workqueue threading layer aborts on parallel
+    # kernels launched from two threads at once, so that needs the tbb or omp layer (it is 1 otherwise, with a warning)
+    FramesInFlight = 1
+    LatencyBudget = 1 / 30  # seconds
+    MaxSpriteDistance = 32  # tiles
+    CullSpritesByTiles = True  # skip sprites on tiles no ray passed through
+    # rays leap across open space with the map's distance field. The leaps don't record the tiles they cross, so it
+    # needs CullSpritesByTiles off (it is ignored with a warning otherwise)
+    SkipEmptySpace = False
+    # compile the kernels for every tile dtype and type of tilt and height, not only this map's and viewer's ones
+    FullWarmUp = False
+    Profile = True  # times the stages of every frame, shown on the HUD
+    ProfileOutput = None  # path of a .csv or .json file the stage times are exported to on exit
+    CProfile = False  # profiles the whole run with cProfile into profiling.prof (slows everything down)
 
     @classmethod
     def fov(cls):
@@ -25,6 +47,16 @@ class RenderSettings:
     def resolution(cls):
         return cls.Resolution
 
+    @classmethod
+    def max_sprite_distance(cls):
+        return cls.MaxSpriteDistance
+
+    @classmethod
+    def threads(cls):
+        if cls.Threads <= 0:
+            return numba.config.NUMBA_NUM_THREADS
+        return min(cls.Threads, numba.config.NUMBA_NUM_THREADS)
+
 
 class Player3D(Player):
 
@@ -53,6 +85,8 @@ class Player3D(Player):
         self.min_height = 0.3
         self.with_ = False
 
+        self.mouse_rotation = structures.RotationMatrix(0)  # reused every frame
+
     @property
     def height(self):
         return self.vertical_position
@@ -70,8 +104,7 @@ class Player3D(Player):
 
     def update_bef(self, dt, keys):
         diffX = pygame.mouse.get_pos()[0] - pg_structures.DisplayMods.current_width / 2
-        self.looking_direction = self.looking_direction * structures.RotationMatrix(diffX / RenderSettings.fov() * 30,
-                                                                                    False)
+        self.looking_direction.rotate_ip(self.mouse_rotation.set_angle(diffX / RenderSettings.fov() * 30, False))
         # self.looking_direction = self.looking_direction * structures.RotationMatrix(90 * dt * self.sensitivity_x, True)
         diffY = pygame.mouse.get_pos()[1] - pg_structures.DisplayMods.current_height / 2
         self.tilt -= diffY * self.sensitivity_y
@@ -128,13 +161,13 @@ class Player3D(Player):
 
     def setup_movement(self):
         self.key_to_function[pygame.K_w] = \
-            lambda: self.set_moving_direction(*self.looking_direction)
+            lambda: self.set_moving_direction(self.looking_direction.x, self.looking_direction.y)
         self.key_to_function[pygame.K_d] = \
-            lambda: self.set_moving_direction(*(self.looking_direction * structures.RotationMatrix.ROT90))
+            lambda: self.set_moving_direction_relative(structures.RotationMatrix.ROT90)
         self.key_to_function[pygame.K_s] = \
-            lambda: self.set_moving_direction(*(self.looking_direction * structures.RotationMatrix.ROT180))
+            lambda: self.set_moving_direction_relative(structures.RotationMatrix.ROT180)
         self.key_to_function[pygame.K_a] = \
-            lambda: self.set_moving_direction(*(self.looking_direction * structures.RotationMatrix.ROT270))
+            lambda: self.set_moving_direction_relative(structures.RotationMatrix.ROT270)
         self.key_to_function[pygame.K_LCTRL] = \
             lambda: self.crouch()
         self.key_to_function[pygame.K_SPACE] = \
@@ -182,6 +215,7 @@ class Background:
         self.type = type_
         self.arg = arg
         self.is_floor = is_floor
+        self.atlas = None  # MipAtlas of a single textured background
 
         self.background = pygame.Surface((self.W * 3, self.H * 1.5)).convert()
 
@@ -208,7 +242,7 @@ class Background:
                 self.arg = self.BIG_TEXTURE(*self.arg)
             if isinstance(self.arg, self.BIG_TEXTURE):  # big texture
                 self.arg = self.BIG_TEXTURE(*(pg_structures.Texture[texture] for texture in self.arg))
-                self.arg = self.BIG_TEXTURE(*(pg_structures.IndexedTexture(texture, False) for texture in self.arg))
+                self.arg = self.BIG_TEXTURE(*pg_structures.IndexedTexture.index_all(self.arg, False))
 
                 srf = pygame.surfarray.make_surface(self.arg.big_texture.array)
                 srf.set_palette(self.arg.big_texture.palette)
@@ -216,13 +250,13 @@ class Background:
             else:
                 self.arg = pg_structures.Texture[r'Textures/Named/' + self.arg]
                 self.arg = pg_structures.IndexedTexture(self.arg, False)
+                self.atlas = pg_structures.IndexedTexture.pack_indexed_atlas([self.arg])
         else:  # otherwise create a list
             folder = pg_structures.Texture.textures_list()
-            for file in folder:
-                pg_structures.IndexedTexture(file, True)
+            pg_structures.IndexedTexture.index_all(folder, True)
             folder = pg_structures.Texture.textures_list()
 
-            self.arg = np.asarray([texture.array for texture in folder])
+            self.arg = pg_structures.IndexedTexture.pack_indexed_atlas(folder)
 
     def imaged_init(self):
         image = pygame.image.load('Assets/Images/Background/' + self.arg)
@@ -233,7 +267,9 @@ class Background:
     def image_rect(image, vertical_angle):
         return 0, 0, image.get_width(), image.get_height() + vertical_angle
 
-    def draw(self, screen, fov, looking_direction, vertical_angle, map_, camera_plane_length, position, height):
+    def draw(self, screen, fov, looking_direction, vertical_angle, map_, camera_plane_length, position, height,
+             buffer=None):
+        """buffer is what cast returned for the same view, None to cast a textured background here"""
         start = 0
         sign = -1 if self.is_floor else 1
 
@@ -257,104 +293,230 @@ class Background:
                         rect)
 
         elif self.type == structures.BackgroundType.textured:
-            if isinstance(self.arg, pg_structures.IndexedTexture):
-                textures_map = np.ndarray(FasterMap.Map.instance.shape, np.int64)
-                textures_map.fill(0)
-
-                textures_array = np.asarray([self.arg.array])
-            elif isinstance(self.arg, np.ndarray):
-                if self.is_floor:
-                    textures_map = FasterMap.Map.instance.floor_array
-                else:
-                    textures_map = FasterMap.Map.instance.ceiling_array
-                textures_array = self.arg
-
-            try:
-                if isinstance(self.arg, (np.ndarray, pg_structures.IndexedTexture)):
-                    background = self.get_floor_ceiling(map_, position, looking_direction, camera_plane_length, screen,
-                                                        textures_map,
-                                                        textures_array,
-                                                        pg_structures.IndexedTexture.palette,
-                                                        height,
-                                                        vertical_angle,
-                                                        self.is_floor
-                                                        )
-                elif isinstance(self.arg, self.BIG_TEXTURE):
-                    background = self.get_floor_ceiling_big_texture(map_, position, looking_direction,
-                                                                    camera_plane_length, screen,
-                                                                    self.arg.big_texture.array,
-                                                                    8,
-                                                                    self.arg.default.array,
-                                                                    pg_structures.IndexedTexture.palette,
-                                                                    height,
-                                                                    vertical_angle,
-                                                                    self.is_floor
-                                                                    )
-
-            except Exception as e:
-                raise e
+            if buffer is None:
+                buffer = self.cast(looking_direction, vertical_angle, map_, camera_plane_length, position, height)
+            background = pygame.surfarray.make_surface(buffer)
+            background.set_palette(pg_structures.IndexedTexture.palette)
             screen.blit(background, (0, start + vertical_angle * self.is_floor))
 
-    @staticmethod
-    def get_floor_ceiling(map_, position, looking_direction, camera_plane_length, screen, textures_map, textures_list,
-                          palette, height, vertical_angle, is_floor):
+    def cast(self, looking_direction, vertical_angle, map_, camera_plane_length, position, height):
+        """
+        Casts a textured background into a palette indexed buffer for draw, None for the other types.
+        Doesn't touch pygame, so it can run on the pipeline's worker
+        """
+        if self.type != structures.BackgroundType.textured:
+            return None
+        if isinstance(self.arg, self.BIG_TEXTURE):
+            return self.get_floor_ceiling_big_texture(map_, position, looking_direction, camera_plane_length, self.W,
+                                                      self.H, self.arg.big_texture.array, 8, self.arg.default.array,
+                                                      height, vertical_angle, self.is_floor)
+        textures_map, textures_array = self.textures()
+        return self.get_floor_ceiling(map_, position, looking_direction, camera_plane_length, self.W, self.H,
+                                      textures_map, textures_array, height, vertical_angle, self.is_floor)
+
+    def textures(self):
+        """Returns the textures map and textures atlas (MipAtlas) of a textured (not big texture) background"""
+        if isinstance(self.arg, pg_structures.IndexedTexture):
+            # the dtype of the map's arrays, so the floor and the ceiling share one compiled signature
+            textures_map = np.zeros(FasterMap.Map.instance.shape, FasterMap.Map.instance.dtype)
+
+            textures_array = self.atlas
+        else:
+            if self.is_floor:
+                textures_map = FasterMap.Map.instance.floor_array
+            else:
+                textures_map = FasterMap.Map.instance.ceiling_array
+            textures_array = self.arg
+        return textures_map, textures_array
 
-        s = screen
-        dir_ = looking_direction.normalized()
-        camera_plane = dir_.tangent() * camera_plane_length
+    @staticmethod
+    def get_floor_ceiling(map_, position, looking_direction, camera_plane_length, W, H, textures_map, textures_list,
+                          height, vertical_angle, is_floor):
+        dir_x, dir_y, camera_x, camera_y = looking_direction.camera_basis(camera_plane_length)
         pos = map_.to_local(position)
 
-        buffer = FasterMap.cast_floor_ceiling(*dir_, *camera_plane, screen.get_width(), screen.get_height(), *pos,
-                                              textures_list, textures_map,
-                                              height,
-                                              int(vertical_angle),
-                                              is_floor
-                                              )
-
-        screen = pygame.surfarray.make_surface(buffer)
-        screen.set_palette(palette)
-
-        return screen
+        return FasterMap.cast_floor_ceiling(dir_x, dir_y, camera_x, camera_y, W, H,
+                                            *pos,
+                                            *textures_list, textures_map,
+                                            height,
+                                            int(vertical_angle),
+                                            is_floor
+                                            )
 
     @staticmethod
-    def get_floor_ceiling_big_texture(map_, position, looking_direction, camera_plane_length, screen, big_texture,
-                                      tile_size, default_texture, palette, height, vertical_angle, is_floor):
-
-        dir_ = looking_direction.normalized()
-        camera_plane = dir_.tangent() * camera_plane_length
+    def get_floor_ceiling_big_texture(map_, position, looking_direction, camera_plane_length, W, H, big_texture,
+                                      tile_size, default_texture, height, vertical_angle, is_floor):
+        dir_x, dir_y, camera_x, camera_y = looking_direction.camera_basis(camera_plane_length)
         pos = map_.to_local(position)
-        s = screen
 
-        buffer = FasterMap.cast_floor_ceiling_big_texture(*dir_, *camera_plane, screen.get_width(), screen.get_height(),
-                                                          *pos,
-                                                          big_texture, tile_size, default_texture,
-                                                          height,
-                                                          int(vertical_angle),
-                                                          is_floor
-                                                          )
-
-        screen = pygame.surfarray.make_surface(buffer)
-        screen.set_palette(palette)
-        # screen = pygame.transform.scale(screen, (s.get_width(), s.get_height()//2))
+        return FasterMap.cast_floor_ceiling_big_texture(dir_x, dir_y, camera_x, camera_y, W, H,
+                                                        *pos,
+                                                        big_texture, tile_size, default_texture,
+                                                        height,
+                                                        int(vertical_angle),
+                                                        is_floor
+                                                        )
 
-        return screen
+    @classmethod
+    def combined(cls):
+        """Whether the floor and ceiling can be cast together (both textured with texture maps)"""
+        return all(background.type == structures.BackgroundType.textured and
+                   isinstance(background.arg, (pg_structures.MipAtlas, pg_structures.IndexedTexture))
+                   for background in (cls.floor, cls.ceiling))
 
     @classmethod
     def draw_background(cls, screen, fov, looking_direction, vertical_angle, map_, camera_plane_length, position,
-                        height, threaded=None):
-        if threaded is None:  # automatically decide
-            threaded = cls.floor.type == cls.ceiling.type == structures.BackgroundType.textured
+                        height, combined=None, floor_buffer=None, ceiling_buffer=None):
+        """floor_buffer and ceiling_buffer are cast already (see cast_backgrounds), None to cast them here"""
+        if combined is None:  # automatically decide
+            combined = cls.combined()
         args = (screen, fov, looking_direction, vertical_angle, map_, camera_plane_length, position, height)
-        if threaded:
-            t1 = Thread(target=cls.floor.draw, args=args)
-            t1.start()
-            t2 = Thread(target=cls.ceiling.draw, args=args)
-            t2.start()
-            t1.join()
-            t2.join()
+        if combined and floor_buffer is not None:
+            cls.blit_floor_and_ceiling(screen, floor_buffer, ceiling_buffer, vertical_angle)
+        elif combined:
+            cls.draw_floor_and_ceiling(*args)
         else:
-            cls.floor.draw(*args)
-            cls.ceiling.draw(*args)
+            cls.floor.draw(*args, floor_buffer)
+            cls.ceiling.draw(*args, ceiling_buffer)
+
+    @classmethod
+    def cast_backgrounds(cls, looking_direction, vertical_angle, map_, camera_plane_length, position, height):
+        """
+        Casts the floor and the ceiling buffers of draw_background, together if they are combined. They are None
+        if they are not textured. Doesn't touch pygame, so it can run on the pipeline's worker
+        """
+        args = (looking_direction, vertical_angle, map_, camera_plane_length, position, height)
+        if cls.combined():
+            return cls.cast_floor_and_ceiling(*args)
+        return cls.floor.cast(*args), cls.ceiling.cast(*args)
+
+    @classmethod
+    def cast_floor_and_ceiling(cls, looking_direction, vertical_angle, map_, camera_plane_length, position, height):
+        """Casts a textured floor and ceiling with one call to the kernel, returns both palette indexed buffers"""
+        dir_x, dir_y, camera_x, camera_y = looking_direction.camera_basis(camera_plane_length)
+        pos = map_.to_local(position)
+
+        floor_map, floor_textures = cls.floor.textures()
+        ceiling_map, ceiling_textures = cls.ceiling.textures()
+        return FasterMap.cast_floor_and_ceiling(dir_x, dir_y, camera_x, camera_y, cls.W, cls.H, *pos,
+                                                *floor_textures, floor_map,
+                                                *ceiling_textures, ceiling_map,
+                                                height,
+                                                int(vertical_angle)
+                                                )
+
+    @classmethod
+    def blit_floor_and_ceiling(cls, screen, floor_buffer, ceiling_buffer, vertical_angle):
+        for background, buffer in ((cls.ceiling, ceiling_buffer), (cls.floor, floor_buffer)):
+            surface = pygame.surfarray.make_surface(buffer)
+            surface.set_palette(pg_structures.IndexedTexture.palette)
+            start = cls.H // 2 if background.is_floor else 0
+            screen.blit(surface, (0, start + vertical_angle * background.is_floor))
+
+    @classmethod
+    def draw_floor_and_ceiling(cls, screen, fov, looking_direction, vertical_angle, map_, camera_plane_length,
+                               position, height):
+        """Draws a textured floor and ceiling with one call to the kernel"""
+        floor_buffer, ceiling_buffer = cls.cast_floor_and_ceiling(looking_direction, vertical_angle, map_,
+                                                                  camera_plane_length, position, height)
+        cls.blit_floor_and_ceiling(screen, floor_buffer, ceiling_buffer, vertical_angle)
+
+
+class FrameBuffers:
+    """Everything that is cast for one frame before it is drawn"""
+
+    def __init__(self, W, resolution, map_shape):
+        self.columns = FasterMap.allocate_columns(W, resolution)
+        self.z_buffer = np.zeros(W, np.float64)
+        self.visited = np.zeros(map_shape, np.uint8)  # tiles the rays passed through
+        self.count = 0  # columns filled
+        self.floor = None  # floor and ceiling buffers (Background.cast_backgrounds), if they were cast with the walls
+        self.ceiling = None
+        self.camera = None
+        self.time = 0  # when the frame was cast
+
+
+class RenderPipeline:
+    """
+    Casts the next frame on a long lived worker while the main thread presents the current one.
+    The kernels release the GIL, so the casting actually runs alongside the main thread.
+    """
+
+    def __init__(self, cast_frame, make_buffers, frames_in_flight=1, latency_budget=1 / 30, workers=1):
+        """
+        :param cast_frame: function (camera, buffers) -> buffers that casts a frame into buffers
+        :param make_buffers: function that creates a new FrameBuffers
+        :param frames_in_flight: maximum amount of frames being cast at once
+        :param latency_budget: seconds a cast frame may wait to be presented. When frames wait longer the game loop
+            is slower than the budget, so prefetching is stopped and every frame is cast when it's collected, until
+            the loop is fast enough again
+        :param workers: worker threads. numba's default threading layer can't run parallel kernels from two threads
+            at once, so more than one needs the tbb or omp layer
+        """
+        self.cast_frame = cast_frame
+        self.frames_in_flight = frames_in_flight
+        self.latency_budget = latency_budget
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='render')
+        self.pending = collections.deque()
+        self.free = [make_buffers() for _ in range(frames_in_flight + 1)]  # one more for the presented frame
+        self.prefetching = True
+        self.last_collect = time.perf_counter()
+        self.collect_cast_time = 0  # seconds collect spent casting the last frame, when it wasn't prefetched
+
+    def submit(self, camera):
+        """Starts casting a frame for camera, does nothing while prefetching is stopped (see latency_budget)"""
+        if not self.prefetching:
+            return
+        if len(self.pending) >= self.frames_in_flight:  # full, the oldest frame won't be presented anyway
+            self.release(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(self.cast, camera, self.free.pop()))
+
+    def cast(self, camera, buffers):
+        buffers = self.cast_frame(camera, buffers)
+        buffers.time = time.perf_counter()
+        return buffers
+
+    def collect(self, camera):
+        """
+        Returns the oldest cast frame, or casts camera on the spot if there is none.
+        The buffers must be released after presenting them
+        """
+        now = time.perf_counter()
+        frame_time, self.last_collect = now - self.last_collect, now
+        if self.pending:
+            buffers = self.pending.popleft().result()
+            self.collect_cast_time = 0
+            # a stale frame is still presented, casting it again would cast every frame twice on a slow machine
+            self.prefetching = time.perf_counter() - buffers.time <= self.latency_budget
+            return buffers
+
+        # prefetching resumes once the loop, without the casting it would take off the main thread, is fast enough
+        self.prefetching = frame_time - self.collect_cast_time <= self.latency_budget
+        buffers = self.executor.submit(self.cast, camera, self.free.pop()).result()  # on the worker, see workers
+        self.collect_cast_time = time.perf_counter() - now
+        return buffers
+
+    def release(self, buffers):
+        self.free.append(buffers)
+
+    @staticmethod
+    def concurrent_kernels():
+        """Whether numba's threading layer runs parallel kernels launched from two threads at once (tbb and omp do)"""
+        try:
+            return numba.threading_layer() in ('tbb', 'omp')
+        except ValueError:  # no parallel kernel ran yet (warm_up runs them), so the layer isn't chosen
+            return False
+
+    def discard(self):
+        """Waits for the frames being cast and drops them"""
+        while self.pending:
+            self.release(self.pending.popleft().result())
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown()
 
 
 class Render3D:
@@ -387,6 +549,9 @@ class Render3D:
 
     def __init__(self, player, map_, screen):
         self.z_buffer = None
+        self.buffers = None  # reused by render_rays every frame
+        self.pipeline = None
+        self.wall_atlas = None
 
         self.W, self.H = screen.get_size()
         self.player: Player3D = player
@@ -396,7 +561,7 @@ class Render3D:
         self.camera_plane_length = structures.DegTrigo.tan(self.fov / 2)
         self.resolution = 3
 
-        pg_structures.Texture.initiate_handler(self.resolution)
+        pg_structures.Texture.initiate_handler(self.resolution, preload=(r'Textures\Mapped2',))  # the map's textures
         self.screen = screen
 
         ceiling_colour = (50, 50, 50)
@@ -441,15 +606,47 @@ class Render3D:
         # pillar = BillboardSprite.LostSoul(r'Sprites\Lost Soul\idle', (150, 75), self.resolution)
         self.bill = BillboardSprite.LostSoul(r'Sprites\Lost Soul\idle', (100, 1450), self.resolution, )
         textures: dict = pg_structures.Texture.textures_list()
-        lst = json.load(open(r'Assets\MapsFiles\sprites_map.pickle', 'rb'))
+        if RenderSettings.SkipEmptySpace:
+            if RenderSettings.CullSpritesByTiles:
+                warnings.warn('RenderSettings.SkipEmptySpace is ignored while CullSpritesByTiles is on, rays that '
+                              'record the tiles they pass through step through every tile')
+            else:
+                map_.build_distance_field()
+        if map_.sprites is not None:  # binary maps carry their sprites
+            lst = [((x, y), id_) for x, y, id_ in map_.sprites.tolist()]
+        else:
+            lst = json.load(open(r'Assets\MapsFiles\sprites_map.pickle', 'rb'))
         ts = FasterMap.Map.instance.tile_size
+        self.props = SpriteStore.SpriteStore(len(lst))  # static, so they don't need a BillboardSprite each
         for (x, y), id_ in lst:
-            BillboardSprite.BillboardSprite(textures[int(id_)], (x * ts + ts // 2, y * ts + ts // 2), vertical_scale=2,
-                                            horizontal_scale=1)
+            self.props.add(textures[int(id_)], (x * ts + ts // 2, y * ts + ts // 2), vertical_scale=2,
+                           horizontal_scale=1)
         self.LS = PanoramicSprites.PanoramicLostSoul(player.position + (100, 1), structures.Vector2(1, 0))
 
         self.viewer = None
         self.set_viewer(self.player)
+        self.profiler = structures.FrameProfiler(enabled=RenderSettings.Profile)
+        self.warm_up_time = self.warm_up()
+
+    def warm_up(self):
+        """
+        Compiles the kernels (or loads them from numba's on disk cache) and renders one frame while loading,
+        so the first frames don't stall. Returns how long it took
+        """
+        start = time.perf_counter()
+        if RenderSettings.FullWarmUp:
+            FasterMap.warm_up()
+            BillboardSprite.warm_up()
+        else:
+            camera = self.camera()
+            # the types of the viewer's tilt and height now, and once it moved (floats)
+            tilt_height_types = {(type(camera.tilt), type(camera.vertical_position)), (float, float)}
+            FasterMap.warm_up(self.map.dtype, tilt_height_types)
+            BillboardSprite.warm_up(tilt_height_types)
+        self.render_background()  # the exact arrays of this map and its textures
+        self.render_rays()
+        self.screen.fill((0, 0, 0))
+        return time.perf_counter() - start
 
     def set_viewer(self, viewer: BillboardSprite.BillboardSprite, smooth=True):
         if isinstance(self.viewer, Render3D.TempViewer):
@@ -460,51 +657,123 @@ class Render3D:
             temp = Render3D.TempViewer(self.viewer, viewer, lambda viewer: self.set_viewer(viewer, smooth=False))
             self.viewer = temp
 
+    def camera(self):
+        """Snapshot of the viewer, so frames can be cast while it keeps moving"""
+        return Camera(self.viewer.position.copy(), self.viewer.looking_direction.copy(), self.viewer.tilt,
+                      self.viewer.vertical_position)
+
+    def render(self):
+        """Renders the background, walls and sprites of the frame"""
+        if self.pipeline is None:
+            self.map.update(self.viewer.position)
+            with self.profiler.scope('render_background'):
+                self.render_background()
+            self.render_rays()
+        else:
+            with self.profiler.scope('collect_frame'):
+                buffers = self.pipeline.collect(self.camera())
+            self.draw_frame(buffers)
+            self.pipeline.release(buffers)
+
+    def prepare_next_frame(self):
+        """Starts casting the next frame on the pipeline (after the viewer moved), does nothing if not pipelined"""
+        if self.pipeline is not None:
+            if self.map.will_update(self.viewer.position):
+                # a ChunkedMap rewrites its window in place, the frames in flight read it and were cast against the
+                # old one (their visited tiles), so they are finished and dropped first
+                self.pipeline.discard()
+                self.map.update(self.viewer.position)
+            self.pipeline.submit(self.camera())
+
+    def start_pipeline(self, frames_in_flight=1, latency_budget=1 / 30):
+        self.stop_pipeline()
+        if frames_in_flight > 1 and not RenderPipeline.concurrent_kernels():
+            warnings.warn(f'{frames_in_flight} frames in flight need the tbb or omp threading layer of numba, '
+                          f'casting 1 frame at a time')
+            frames_in_flight = 1
+        self.pipeline = RenderPipeline(lambda camera, buffers: self.cast_frame(camera, buffers, True),
+                                       lambda: FrameBuffers(self.W, self.resolution, self.map.shape),
+                                       frames_in_flight, latency_budget)
+
+    def stop_pipeline(self):
+        if self.pipeline is not None:
+            self.pipeline.close()
+            self.pipeline = None
+
     def render_rays(self):
-        dir_ = self.viewer.looking_direction.normalized()
-        camera_plane = dir_.tangent() * self.camera_plane_length
-        self.cast_and_draw(dir_, camera_plane)
-
-    def cast_and_draw(self, dir_, camera_plane):
-        pos = self.map.to_local(self.viewer.position)
-        resolution = self.resolution
-        # screen = pygame.Surface(self.screen.get_size())
+        if self.buffers is None or len(self.buffers.columns) != len(range(0, self.W, self.resolution)):
+            self.buffers = FrameBuffers(self.W, self.resolution, self.map.shape)
+        with self.profiler.scope('render_rays'):
+            self.cast_frame(self.camera(), self.buffers, False)
+        self.draw_walls(self.buffers)
+        return self.screen
+
+    def load_wall_atlas(self):
+        textures: dict = pg_structures.Texture.textures_list()
+        textures = [texture for texture in textures if not isinstance(texture, dict)]
+        self.wall_atlas = pg_structures.Texture.pack_atlas(textures)
+
+    def cast_frame(self, camera, buffers, with_background):
+        """
+        Casts the walls (and the floor and ceiling if with_background) seen from camera into buffers.
+        Doesn't touch the screen, so it can run on the pipeline's worker
+        """
+        if self.wall_atlas is None:
+            self.load_wall_atlas()
+
+        dir_x, dir_y, camera_x, camera_y = camera.looking_direction.camera_basis(self.camera_plane_length)
+        pos = self.map.to_local(camera.position)
+
+        threads = RenderSettings.threads()
+        if threads > 1:
+            numba.set_num_threads(threads)
+            cast = FasterMap.cast_screen_parallel
+        else:
+            cast = FasterMap.cast_screen_batch
+
+        visited = buffers.visited if RenderSettings.CullSpritesByTiles else FasterMap.no_visits
+        buffers.count = cast(buffers.columns, buffers.z_buffer, visited, self.map.distances, self.W, self.resolution,
+                             self.map.map(), pos[0], pos[1], dir_x, camera_x, dir_y, camera_y, self.H, camera.tilt,
+                             camera.vertical_position, self.wall_atlas.widths, self.wall_atlas.heights)
+
+        if with_background:
+            buffers.floor, buffers.ceiling = Background.cast_backgrounds(camera.looking_direction, camera.tilt,
+                                                                         self.map, self.camera_plane_length,
+                                                                         camera.position, camera.vertical_position)
+        else:
+            buffers.floor = buffers.ceiling = None
+        buffers.camera = camera
+        return buffers
+
+    def draw_frame(self, buffers):
+        """Draws a frame cast by cast_frame: background, walls and sprites"""
+        camera = buffers.camera
+        with self.profiler.scope('render_background'):
+            Background.draw_background(self.screen, self.fov, camera.looking_direction, camera.tilt, self.map,
+                                       self.camera_plane_length, camera.position, camera.vertical_position,
+                                       floor_buffer=buffers.floor, ceiling_buffer=buffers.ceiling)
+        self.draw_walls(buffers)
+
+    def draw_walls(self, buffers):
         screen = self.screen
         screen.set_colorkey(pygame.Color('black'))
 
-        # texture = self.texture
-        textures: dict = pg_structures.Texture.textures_list()
-        heights = np.asarray([texture.texture.get_height() for texture in textures if not isinstance(texture, dict)])
-        widths = np.asarray([texture.texture.get_width() for texture in textures if not isinstance(texture, dict)])
-        # heights[0] = 0
-        # widths[0] = 0
-        # for id_, tex in enumerate(textures):
-        #     if isinstance(tex, dict):
-        #         continue
-        #     heights[int(id_)] = tex.texture.get_height()
-        #     widths[int(id_)] = tex.texture.get_width()
-        for x, colStart, colHeight, yStart, yHeight, color, texX, buffer, tile_id in \
-                FasterMap.cast_screen(self.W, resolution, self.map.map(), pos[0], pos[1], dir_.x, camera_plane.x,
-                                      dir_.y,
-                                      camera_plane.y, self.H, self.viewer.tilt, self.viewer.vertical_position,
-                                      widths, heights):
-            if x < 0:
-                break
-            if tile_id == 0:
-                continue
-            texture = textures[tile_id].texture
-            # if 3:
-            # pygame.draw.rect(screen, (color, color, color), (x, yStart, resolution, yHeight))
-            if colHeight > 0 and colStart < heights[tile_id]:
-                # column = texture.sca
-                column = texture.subsurface((texX, colStart, 1, colHeight)).copy()
-                column.fill((color, color, color), special_flags=pygame.BLEND_MULT)
-                column = pygame.transform.scale(column, (resolution, yHeight))
-                screen.blit(column, (x, yStart))
-        self.z_buffer = buffer
-
-        BillboardSprite.BillboardSprite.draw_all(self.viewer, self.camera_plane_length, self.W, self.H, self.z_buffer,
-                                                 self.resolution, screen)
+        if RenderSettings.threads() > 1:
+            draw = FasterMap.draw_wall_columns_parallel
+        else:
+            draw = FasterMap.draw_wall_columns
+
+        with self.profiler.scope('draw_walls'):
+            frame = pygame.surfarray.pixels3d(screen)  # locks the screen until deleted
+            draw(frame, self.wall_atlas.array, self.wall_atlas.widths, self.wall_atlas.heights,
+                 self.wall_atlas.offsets, buffers.columns, buffers.count, self.resolution)
+            del frame
+        self.z_buffer = buffers.z_buffer
+
+        visited = buffers.visited if RenderSettings.CullSpritesByTiles else None
+        with self.profiler.scope('draw_sprites'):
+            BillboardSprite.BillboardSprite.draw_all(self.viewer, self.camera_plane_length, self.W, self.H,
+                                                     self.z_buffer, self.resolution, screen, visited, buffers.camera)
         return screen
 
     def render_background(self):
@@ -553,9 +822,13 @@ def main():
     elaspeds = []
 
     pistol = Weapon('Assets/Weapons/Pistol', 8, -1, screen)
+    profiler = renderer.profiler
+    hud = pg_structures.ProfilerHUD(profiler, pygame.font.SysFont("Roboto", 24), color)
+
+    if RenderSettings.Pipelined:
+        renderer.start_pipeline(RenderSettings.FramesInFlight, RenderSettings.LatencyBudget)
 
     while running:
-        renderer.render_background()
         events = pygame.event.get()
         for event in events:
             if event.type == pygame.QUIT:
@@ -579,10 +852,12 @@ def main():
 
         keys = pygame.key.get_pressed()
 
-        renderer.render_rays()
+        renderer.render()
 
         # player._update(elapsed, keys)
-        Sprites.BaseSprite.update_all(elapsed, keys)
+        with profiler.scope('update_all'):
+            Sprites.BaseSprite.update_all(elapsed, keys)
+        renderer.prepare_next_frame()  # casts while the HUD is drawn and the display is updated
         fps_now = clock.get_fps()
         fps += fps_now
         frames += 1
@@ -592,10 +867,13 @@ def main():
         average_frame *= 0.9
         average_frame += 0.1 * elapsed_real
 
-        fps_sur = font.render(str(round(1000 / average_frame)), False, color)
-        screen.blit(fps_sur, (0, 0))
-        tilt_sur = font.render("{}".format(global_val), False, pygame.Color('white'))
-        screen.blit(tilt_sur, (0, 40))
+        if profiler.enabled:
+            hud.draw(screen)
+        else:
+            fps_sur = font.render(str(round(1000 / average_frame)), False, color)
+            screen.blit(fps_sur, (0, 0))
+            tilt_sur = font.render("{}".format(global_val), False, pygame.Color('white'))
+            screen.blit(tilt_sur, (0, 40))
 
         pistol.draw()
 
@@ -605,19 +883,27 @@ def main():
         # new = screen
         # new = pygame.transform.scale(screen, real_screen.get_size(), real_screen)
         # pygame.transform.scale(screen, Realscreen.get_size(), Realscreen)
-        pygame.display.update()
+        with profiler.scope('display_update'):
+            pygame.display.update()
+        profiler.end_frame()
 
+    renderer.stop_pipeline()
     print(fps / frames)
+    if RenderSettings.ProfileOutput is not None:
+        profiler.export(RenderSettings.ProfileOutput)
 
 
 if __name__ == '__main__':
-    import cProfile
-    import pstats
-
-    profiler = cProfile.Profile()
-    profiler.enable()
-    main()
-    profiler.disable()
-    stats = pstats.Stats(profiler)
-    stats.sort_stats(pstats.SortKey.TIME)
-    stats.dump_stats(filename='profiling.prof')
+    if RenderSettings.CProfile:
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        main()
+        profiler.disable()
+        stats = pstats.Stats(profiler)
+        stats.sort_stats(pstats.SortKey.TIME)
+        stats.dump_stats(filename='profiling.prof')
+    else:
+        main()
@@ -1,14 +1,17 @@
 import math
 import pathlib
 
+import numpy as np
 import pygame
 
 import structures
 import pg_structures
 from structures import RotationMatrix
 from .Sprites import BaseSprite
+from .SpatialIndex import SpriteGrid
+from .SpriteStore import SpriteStore
 from numba import njit
-from FasterMap import Map
+from FasterMap import Map, pixels_like, TILT_HEIGHT_TYPES
 import os
 from itertools import chain
 import sys
@@ -27,7 +30,7 @@ import sys
 #     if isinstance(value, pygame.Surface):
 #         instance.__dict__[self.name] = value
 
-@njit()
+@njit(cache=True)
 def cast_sprite(world_sprite_x, world_sprite_y, pos_x, pos_y, plane_x, plane_y, dir_x, dir_y, W, H, z_buffer,
                 text_width, text_height, camera_height, tilt, vertical_position, vertical_scale, horizontal_scale):
 
@@ -81,8 +84,158 @@ def cast_sprite(world_sprite_x, world_sprite_y, pos_x, pos_y, plane_x, plane_y,
             # x, y_texture_start, y_start, y_height, tex_x, draw_height in cast_sprite(
 
 
+@njit(nogil=True, fastmath=True, cache=True)
+def draw_sprite(frame, texture, mip_offsets, colorkey, text_width, text_height, world_sprite_x, world_sprite_y, pos_x,
+                pos_y, plane_x, plane_y, dir_x, dir_y, W, H, z_buffer, camera_height, tilt, vertical_position,
+                vertical_scale, horizontal_scale, resolution):
+    """
+    Draws one sprite straight into frame (a (W, H, 3) pixels array), the same as blitting every stripe cast_sprite
+    yields. Texels equal to colorkey (-1 for none) are transparent
+    """
+    sprite_x = world_sprite_x - pos_x
+    sprite_y = world_sprite_y - pos_y
+    inv_det = 1 / (plane_x * dir_y - dir_x * plane_y)
+    transform_x = inv_det * (dir_y * sprite_x - dir_x * sprite_y)
+    transform_y = inv_det * (- plane_y * sprite_x + plane_x * sprite_y)
+    if transform_y <= 0:  # behind the camera
+        return
+
+    sprite_screen_x = int((W // 2) * (1 + transform_x / transform_y))
+
+    inv_height = 2 - camera_height
+    draw_height = sprite_height = abs(int(H / transform_y / vertical_scale))
+    height_pixel = H // transform_y
+    v_move_screen = height_pixel - sprite_height + (vertical_position) // transform_y
+    draw_start_y = - inv_height * height_pixel // 2 + H // 2 + v_move_screen + tilt
+
+    sprite_width = abs(int(H / transform_y / horizontal_scale))
+    if draw_height == 0 or sprite_width == 0:
+        return
+
+    draw_start_x = max(0, -sprite_width // 2 + sprite_screen_x)
+    draw_end_x = min(W, sprite_width // 2 + sprite_screen_x)
+
+    y_start = max(0, draw_start_y)
+    y_stop = min(H, draw_height + draw_start_y)
+
+    pixels_per_texel = draw_height / text_height
+
+    col_start = int((y_start - draw_start_y) / pixels_per_texel + .5)
+    col_height = int((y_stop - y_start) / pixels_per_texel + .5)
+
+    if col_height < 0 or col_start + col_height > text_height:
+        return
+
+    y_texture_start = int(col_start * pixels_per_texel)
+    y_start = int(col_start * pixels_per_texel + draw_start_y + .5)
+    y_height = int(col_height * pixels_per_texel + .5)
+
+    # FasterMap.mip_level, inlined: numba's cache doesn't notice changes to functions of other modules it calls
+    level = 0
+    texels_per_pixel = text_height / draw_height
+    while texels_per_pixel >= 2 and level < mip_offsets.shape[0] - 1:
+        texels_per_pixel /= 2
+        level += 1
+    level_width = max(1, text_width >> level)
+    level_height = max(1, text_height >> level)
+
+    for stripe in range(draw_start_x, draw_end_x):
+        if not (z_buffer[stripe] > transform_y and stripe > 0):
+            continue
+        tex_x = int(round(int(256 * (stripe - (-sprite_width / 2 + sprite_screen_x)) * text_width / sprite_width)
+                          / 256))
+        if tex_x < 0 or tex_x >= text_width:  # -sprite_width // 2 rounds down, the first stripe can be left of it
+            continue
+        level_x = mip_offsets[level] + min(tex_x >> level, level_width - 1)
+        x_stop = min(stripe + resolution, W)
+        for j in range(y_height):
+            y = y_start + j
+            if y < 0:
+                continue
+            if y >= H:
+                break
+            tex_y = int((y_texture_start + j) * text_height / draw_height)
+            if tex_y >= text_height:
+                break
+            if colorkey[0] >= 0 and texture[tex_x, tex_y, 0] == colorkey[0] and \
+                    texture[tex_x, tex_y, 1] == colorkey[1] and texture[tex_x, tex_y, 2] == colorkey[2]:
+                continue
+            level_y = min(tex_y >> level, level_height - 1)
+            for channel in range(3):
+                value = texture[level_x, level_y, channel]
+                for column in range(stripe, x_stop):
+                    frame[column, y, channel] = value
+
+
+@njit(nogil=True, cache=True)
+def draw_sprites(frame, atlas, tex_widths, tex_heights, mip_offsets, colorkeys, sprites_x, sprites_y,
+                 vertical_positions, vertical_scales, horizontal_scales, texture_ids, pos_x, pos_y, plane_x, plane_y,
+                 dir_x, dir_y, W, H, z_buffer, camera_height, tilt, resolution):
+    """
+    Draws all the sprites (given as arrays, positions in tiles) into frame, farthest first.
+    The textures are in atlas (see pg_structures.Texture.pack_atlas)
+    """
+    order = np.argsort(-((sprites_x - pos_x) ** 2 + (sprites_y - pos_y) ** 2))
+    for i in order:
+        texture_id = texture_ids[i]
+        draw_sprite(frame, atlas[texture_id], mip_offsets[texture_id], colorkeys[texture_id],
+                    tex_widths[texture_id], tex_heights[texture_id], sprites_x[i], sprites_y[i], pos_x, pos_y,
+                    plane_x, plane_y, dir_x, dir_y, W, H, z_buffer, camera_height, tilt,
+                    -(vertical_positions[i] - 1) * H, vertical_scales[i], horizontal_scales[i], resolution)
+
+
+def warm_up(tilt_height_types=TILT_HEIGHT_TYPES):
+    """Compiles (or loads from numba's cache) the sprite kernels, like FasterMap.warm_up"""
+    W, H = 8, 6
+    frame = pixels_like(W, H)
+    sizes = np.full(1, 4, np.int64)
+    offsets = np.array([[0, 4, 6]], np.int64)
+    atlas = np.zeros((1, 7, 4, 3), np.uint8)
+    colorkeys = np.full((1, 3), -1, np.int64)
+    ones = np.ones(1, np.float64)
+    z_buffer = np.full(W, np.inf)
+    for tilt_type, height_type in tilt_height_types:  # the viewer's tilt and height
+        tilt, height = tilt_type(1), height_type(1)
+        draw_sprites(frame, atlas, sizes, sizes, offsets, colorkeys, ones * 2, ones, ones, ones, ones,
+                     np.zeros(1, np.int64), 1.0, 1.0, 0.0, 0.66, 1.0, 0.0, W, H, z_buffer, height, tilt, 1)
+        for _ in cast_sprite(2.0, 1.0, 1.0, 1.0, 0.0, 0.66, 1.0, 0.0, W, H, z_buffer, 4, 4, height, tilt, 0.0, 1.0,
+                             1.0):
+            pass
+
+
+class SpriteAtlas:
+    """Packs the textures of the billboard sprites for draw_sprites, packed again when new textures show up"""
+
+    def __init__(self):
+        self.ids = {}  # texture: id
+        self.textures = []
+        self.atlas = None
+        self.colorkeys = None
+
+    def add(self, textures):
+        for texture in textures:
+            if texture not in self.ids:
+                self.ids[texture] = len(self.textures)
+                self.textures.append(texture)
+                self.atlas = None
+
+    def id(self, texture):
+        self.add((texture, ))
+        return self.ids[texture]
+
+    def pack(self):
+        if self.atlas is None:
+            self.atlas = pg_structures.Texture.pack_atlas(self.textures)
+            self.colorkeys = np.asarray([
+                tuple(texture.texture.get_colorkey() or (-1, -1, -1, -1))[:3] for texture in self.textures
+            ], np.int64)
+        return self.atlas, self.colorkeys
+
+
 class BillboardSprite(BaseSprite):
     billboard_sprites = []
+    grid = SpriteGrid()
+    atlas = SpriteAtlas()
 
     RenderSettings = None
     # self.texture = AnimationDescriptor()
@@ -96,6 +249,7 @@ class BillboardSprite(BaseSprite):
         super(BillboardSprite, self).__init__(position, velocity, *rect_size)
         self.tilt = tilt
         self.billboard_sprites.append(self)
+        self.grid.add(self)
 
         self.resolution = resolution
         self.animation = self.get_animation(texture, fps=fps)
@@ -153,36 +307,123 @@ class BillboardSprite(BaseSprite):
             return texture
 
     @classmethod
-    def draw_all(cls, viewer, camera_plane_length, W, H, z_buffer, resolution, screen):
+    def draw_all(cls, viewer, camera_plane_length, W, H, z_buffer, resolution, screen, visited=None, camera=None):
+        """
+        Draws all the billboard sprites with one call to draw_sprites
+        :param visited: tiles the rays passed through this frame (see FasterMap.cast_screen_batch), sprites on other
+            tiles are occluded and skipped. None to draw every sprite in the frustum
+        :param camera: the point of view z_buffer was cast from (position, looking_direction, tilt and
+            vertical_position, like the viewer's), when it isn't the viewer's current one (a pipelined frame)
+        """
         viewer: BillboardSprite
-        cls.billboard_sprites.sort(key=lambda sprite: (sprite.position - viewer.position).magnitude_squared(),
-                                   reverse=True)
-
-        for sprite in cls.billboard_sprites:
-            sprite.draw_3D(viewer, camera_plane_length, W, H, z_buffer, resolution, screen)
+        if camera is None:
+            camera = viewer
+        if viewer in cls.billboard_sprites:
+            viewer.self_draw()
+        dir_x, dir_y, camera_x, camera_y = camera.looking_direction.camera_basis(camera_plane_length)
+        max_distance = Map.instance.to_global(cls.RenderSettings.max_sprite_distance())
+        sprites = [sprite for sprite in cls.grid.query(camera.position, (dir_x, dir_y), camera_plane_length, max_distance)
+                   if sprite is not viewer]
+
+        for sprite in sprites:
+            sprite.prepare_draw(camera)
+            cls.atlas.add(sprite.textures())
+        positions = [np.asarray([Map.instance.to_local(sprite.position) for sprite in sprites], np.float64)
+                     .reshape(-1, 2)]
+        vertical_positions = [np.asarray([sprite.vertical_position for sprite in sprites], np.float64)]
+        vertical_scales = [np.asarray([sprite.vertical_scale for sprite in sprites], np.float64)]
+        horizontal_scales = [np.asarray([sprite.horizontal_scale for sprite in sprites], np.float64)]
+        texture_ids = [np.asarray([cls.atlas.id(sprite.get_current_texture()) for sprite in sprites], np.int64)]
+
+        for store in SpriteStore.stores:
+            indices = store.visible((camera.position.x, camera.position.y), (dir_x, dir_y), max_distance)
+            if not len(indices):
+                continue
+            if len(store.atlas_ids) != len(store.textures):
+                cls.atlas.add(store.textures)
+                store.atlas_ids = np.asarray([cls.atlas.id(texture) for texture in store.textures], np.int64)
+            positions.append(store.position[indices] / Map.instance.tile_size - Map.instance.origin)
+            vertical_positions.append(store.vertical_position[indices])
+            vertical_scales.append(store.vertical_scale[indices])
+            horizontal_scales.append(store.horizontal_scale[indices])
+            texture_ids.append(store.atlas_ids[store.frame[indices]])
+
+        positions, vertical_positions, vertical_scales, horizontal_scales, texture_ids = map(
+            np.concatenate, (positions, vertical_positions, vertical_scales, horizontal_scales, texture_ids))
+        if visited is not None:
+            visible = cls.on_visited_tiles(positions, horizontal_scales, visited)
+            positions, vertical_positions, vertical_scales, horizontal_scales, texture_ids = \
+                positions[visible], vertical_positions[visible], vertical_scales[visible], \
+                horizontal_scales[visible], texture_ids[visible]
+        if not len(texture_ids):
+            return
+        atlas, colorkeys = cls.atlas.pack()
+        viewer_position = Map.instance.to_local(camera.position)
+
+        frame = pygame.surfarray.pixels3d(screen)  # locks the screen until deleted
+        draw_sprites(frame, atlas.array, atlas.widths, atlas.heights, atlas.offsets, colorkeys,
+                     positions[:, 0], positions[:, 1],
+                     vertical_positions,
+                     vertical_scales,
+                     horizontal_scales,
+                     texture_ids,
+                     viewer_position[0], viewer_position[1],
+                     camera_x, camera_y,
+                     dir_x, dir_y,
+                     W, H,
+                     z_buffer,
+                     camera.vertical_position,
+                     camera.tilt,
+                     resolution)
+        del frame
+
+    @staticmethod
+    def on_visited_tiles(positions, horizontal_scales, visited):
+        """
+        Returns a mask of the sprites (positions in tiles) that overlap a tile in visited.
+        Sprites wider than a tile are always kept
+        """
+        half_widths = .5 / horizontal_scales
+        height, width = visited.shape
+        visible = half_widths > .5
+        for corner_x in (-1, 1):
+            for corner_y in (-1, 1):
+                tile_x = (positions[:, 0] + corner_x * half_widths).astype(np.int64)
+                tile_y = (positions[:, 1] + corner_y * half_widths).astype(np.int64)
+                inside = (0 <= tile_x) & (tile_x < width) & (0 <= tile_y) & (tile_y < height)
+                visible[inside] |= visited[tile_y[inside], tile_x[inside]].astype(bool)
+        return visible
 
     def self_draw(self):
         pass
 
+    def prepare_draw(self, viewer):
+        """Called before the sprite is drawn from viewer's point of view"""
+        pass
+
+    def textures(self):
+        """All the textures the sprite may be drawn with"""
+        return [frame.image for frame in self.animation.images_list]
+
     def draw_3D(self, viewer, camera_plane_length, W, H, z_buffer, resolution, screen):
         viewer: BillboardSprite
         if viewer is self:
             return self.self_draw()
+        self.prepare_draw(viewer)
 
         viewer_position = Map.instance.to_local(viewer.position)
         texture = self.get_current_texture()
         image = texture.texture
 
-        dir_ = viewer.looking_direction.normalized()
-        camera_plane = dir_.tangent() * camera_plane_length
+        dir_x, dir_y, camera_x, camera_y = viewer.looking_direction.camera_basis(camera_plane_length)
 
         pos = Map.instance.to_local(self.position)
         try:
             for x, y_texture_start, y_start, y_height, tex_x, draw_height in cast_sprite(
                     pos[0], pos[1],
                     viewer_position[0], viewer_position[1],
-                    camera_plane.x, camera_plane.y,
-                    dir_.x, dir_.y,
+                    camera_x, camera_y,
+                    dir_x, dir_y,
                     W, H,
                     z_buffer,
                     image.get_width(), image.get_height(),
@@ -207,9 +448,14 @@ class BillboardSprite(BaseSprite):
     def initiate(cls, render_settings):
         cls.RenderSettings = render_settings
 
+    def _update(self, dt, keys):
+        super(BillboardSprite, self)._update(dt, keys)
+        self.grid.move(self)
+
     def kill(self) -> None:
         super(BillboardSprite, self).kill()
         self.billboard_sprites.remove(self)
+        self.grid.remove(self)
 
 
 class LostSoul(BillboardSprite):
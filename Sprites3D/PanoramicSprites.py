@@ -45,14 +45,16 @@ class DirectionalSprite(Sprites3D.BillboardSprite.BillboardSprite):
         # 180 degrees - facing directly
 
     def rotate(self, deg, radians=False):
-        self.looking_direction *= structures.RotationMatrix(deg, radians)
+        self.looking_direction.rotate_ip(structures.RotationMatrix(deg, radians))
 
     def set_looking_direction(self, new):
         self.looking_direction.set_values(new)
 
-    def draw_3D(self, viewer, *args, **kwargs):
+    def prepare_draw(self, viewer):
         self.animation = self.animations.closest(((self.position - Map.instance.to_global(viewer.position)).angle() - viewer.looking_direction.angle()) % 360)
-        super(DirectionalSprite, self).draw_3D(viewer, *args, **kwargs)
+
+    def textures(self):
+        return [frame.image for animation in self.animations.values() for frame in animation.images_list]
 
 
 class PanoramicLostSoul(DirectionalSprite):
@@ -0,0 +1,83 @@
+import math
+
+from FasterMap import Map
+
+
+class SpriteGrid:
+    """
+    Buckets sprites by the map cells they are in (cell_tiles x cell_tiles map tiles per bucket), so only the sprites
+    around the viewer are looked at every frame
+    """
+
+    def __init__(self, cell_tiles=4, tile_size=Map.TILE_SIZE):
+        self.cell_size = cell_tiles * tile_size
+        self.cells = {}  # (cell x, cell y): set of sprites
+        self.sprite_cells = {}  # sprite: (cell x, cell y)
+
+    def cell_of(self, position):
+        return int(position[0] // self.cell_size), int(position[1] // self.cell_size)
+
+    def __len__(self):
+        return len(self.sprite_cells)
+
+    def add(self, sprite):
+        cell = self.cell_of(sprite.position)
+        self.cells.setdefault(cell, set()).add(sprite)
+        self.sprite_cells[sprite] = cell
+
+    def remove(self, sprite):
+        cell = self.sprite_cells.pop(sprite, None)
+        if cell is None:
+            return
+        bucket = self.cells[cell]
+        bucket.discard(sprite)
+        if not bucket:
+            del self.cells[cell]
+
+    def move(self, sprite):
+        """Moves sprite to the bucket of its current position, call it after it moved"""
+        cell = self.cell_of(sprite.position)
+        if self.sprite_cells.get(sprite) != cell:
+            self.remove(sprite)
+            self.add(sprite)
+
+    def query(self, position, direction, camera_plane_length, max_distance):
+        """
+        Returns the sprites that may be seen from position
+        :param position: viewer position (global)
+        :param direction: normalized looking direction
+        :param camera_plane_length: length of the camera plane (tan of half the fov)
+        :param max_distance: maximum draw distance (global)
+        :return: list of sprites inside the view frustum and closer than max_distance
+        """
+        x, y = position
+        dir_x, dir_y = direction
+        plane_x, plane_y = -dir_y, dir_x
+
+        # bounding box of the view triangle
+        corners_x = (x, x + (dir_x - plane_x * camera_plane_length) * max_distance,
+                     x + (dir_x + plane_x * camera_plane_length) * max_distance)
+        corners_y = (y, y + (dir_y - plane_y * camera_plane_length) * max_distance,
+                     y + (dir_y + plane_y * camera_plane_length) * max_distance)
+        min_cell_x, min_cell_y = self.cell_of((min(corners_x), min(corners_y)))
+        max_cell_x, max_cell_y = self.cell_of((max(corners_x), max(corners_y)))
+
+        # a cell is kept if any of it (and the sprites sticking out of it) may be in the frustum
+        margin = self.cell_size * math.sqrt(2) / 2 + Map.TILE_SIZE
+        max_distance_squared = max_distance * max_distance
+        sprites = []
+        for cell_x in range(min_cell_x, max_cell_x + 1):
+            for cell_y in range(min_cell_y, max_cell_y + 1):
+                bucket = self.cells.get((cell_x, cell_y))
+                if not bucket:
+                    continue
+                relative_x = (cell_x + .5) * self.cell_size - x
+                relative_y = (cell_y + .5) * self.cell_size - y
+                depth = relative_x * dir_x + relative_y * dir_y
+                side = relative_x * plane_x + relative_y * plane_y
+                if depth < -margin or abs(side) > (depth + margin) * camera_plane_length + margin:
+                    continue
+                for sprite in bucket:
+                    if (sprite.position.x - x) ** 2 + (sprite.position.y - y) ** 2 <= max_distance_squared:
+                        sprites.append(sprite)
+        return sprites
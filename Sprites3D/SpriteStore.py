@@ -0,0 +1,118 @@
+import numpy as np
+
+from FasterMap import Map
+
+
+class SpriteStore:
+    """
+    Structure of arrays storage for simple billboard sprites: static or moving at a constant velocity, with an
+    optional looping animation. Positions are global like BaseSprite's. All the sprites of a store are updated with a
+    few array operations instead of a Python call chain per sprite
+    """
+    stores = []
+
+    ARRAYS = ('position', 'velocity', 'rect_size', 'vertical_position', 'vertical_scale', 'horizontal_scale',
+              'wall_collision', 'first_frame', 'frame_count', 'fps', 'frame')
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.position = np.zeros((capacity, 2), np.float64)
+        self.velocity = np.zeros((capacity, 2), np.float64)
+        self.rect_size = np.ones((capacity, 2), np.float64)
+        self.vertical_position = np.ones(capacity, np.float64)
+        self.vertical_scale = np.ones(capacity, np.float64)
+        self.horizontal_scale = np.ones(capacity, np.float64)
+        self.wall_collision = np.ones(capacity, bool)
+        self.first_frame = np.zeros(capacity, np.int64)  # index of the first animation frame in textures
+        self.frame_count = np.ones(capacity, np.int64)
+        self.fps = np.zeros(capacity, np.float64)
+        self.frame = np.zeros(capacity, np.int64)  # index of the current animation frame in textures
+
+        self.textures = []  # frames of all the animations, the frames of each animation are consecutive
+        self.animations = {}  # tuple of frames: index of its first frame in textures
+        self.atlas_ids = np.zeros(0, np.int64)  # textures mapped to BillboardSprite.atlas, filled by draw_all
+        self.time = 0
+        self.stores.append(self)
+
+    def __len__(self):
+        return self.count
+
+    def grow(self):
+        """Doubles the capacity of the arrays, a store of capacity 0 grows to 1"""
+        for name in self.ARRAYS:
+            array = getattr(self, name)
+            extra = np.zeros((max(1, len(array)),) + array.shape[1:], array.dtype)
+            setattr(self, name, np.concatenate((array, extra)))
+
+    def add(self, textures, position, velocity=(0, 0), vertical_position=1, vertical_scale=1, horizontal_scale=1,
+            fps=0, rect_size=(1, 1), wall_collision=True):
+        """
+        Adds a sprite to the store
+        :param textures: texture (pg_structures.Texture) or list of the animation frames
+        :param fps: animation frames per second, 0 for no animation
+        :return: index of the sprite
+        """
+        if not isinstance(textures, (list, tuple)):
+            textures = [textures]
+        textures = tuple(textures)
+        if textures not in self.animations:
+            self.animations[textures] = len(self.textures)
+            self.textures.extend(textures)
+        if self.count == len(self.position):
+            self.grow()
+        index = self.count
+        self.count += 1
+
+        self.position[index] = position
+        self.velocity[index] = velocity
+        self.rect_size[index] = rect_size
+        self.vertical_position[index] = vertical_position
+        self.vertical_scale[index] = vertical_scale
+        self.horizontal_scale[index] = horizontal_scale
+        self.wall_collision[index] = wall_collision
+        self.first_frame[index] = self.animations[textures]
+        self.frame_count[index] = len(textures)
+        self.fps[index] = fps
+        self.frame[index] = self.animations[textures]
+        return index
+
+    def remove(self, index):
+        """Removes the sprite at index. The last sprite takes its place (and its index)"""
+        last = self.count - 1
+        for name in self.ARRAYS:
+            array = getattr(self, name)
+            array[index] = array[last]
+        self.count -= 1
+
+    def update(self, dt):
+        n = self.count
+        self.time += dt
+        self.frame[:n] = self.first_frame[:n] + \
+            (self.time * self.fps[:n]).astype(np.int64) % self.frame_count[:n]
+
+        moving = np.flatnonzero(np.any(self.velocity[:n] != 0, axis=1))
+        if not len(moving):
+            return
+        displacement = self.velocity[moving] * dt
+        for axis in (0, 1):  # like BaseSprite.update_kinematics, one axis at a time
+            self.position[moving, axis] += displacement[:, axis]
+            self.collide(moving[self.wall_collision[moving]], axis,
+                         displacement[self.wall_collision[moving], axis])
+
+    def collide(self, indices, axis, displacement):
+        """Moves the sprites at indices that hit a wall on axis back to its edge, like BaseSprite.x/y_collision"""
+        positions = self.position[indices]
+        Map.instance.collide_boxes(positions, self.rect_size[indices] / 2, displacement, axis)
+        self.position[indices] = positions
+
+    @classmethod
+    def update_all(cls, dt):
+        for store in cls.stores:
+            store.update(dt)
+
+    def visible(self, position, direction, max_distance):
+        """Indices of the sprites in front of position and closer than max_distance (global)"""
+        relative = self.position[:self.count] - position
+        depth = relative @ direction
+        distance_squared = (relative * relative).sum(axis=1)
+        return np.flatnonzero((depth > -Map.instance.tile_size) & (distance_squared <= max_distance * max_distance))
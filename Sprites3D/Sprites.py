@@ -1,9 +1,7 @@
 import pygame
 from structures import Vector2
-import typing
 import FasterMap as Map
-
-dx = 0.000001
+from .SpriteStore import SpriteStore
 
 
 class BaseSprite(pygame.sprite.Sprite):
@@ -14,6 +12,7 @@ class BaseSprite(pygame.sprite.Sprite):
         self.wall_collision = True
         self.position = Vector2(*position)
         self.velocity = Vector2(*velocity)
+        self.displacement = Vector2(0, 0)  # of the last update, reused every frame
 
         self.rw = rect_width
         self.rh = rect_height
@@ -31,6 +30,7 @@ class BaseSprite(pygame.sprite.Sprite):
     def update_all(cls, dt, keys):
         for sprite in cls.sprites:
             sprite._update(dt, keys)
+        SpriteStore.update_all(dt)
 
     def _update(self, dt, keys):
         self.update_bef(dt, keys)
@@ -43,7 +43,7 @@ class BaseSprite(pygame.sprite.Sprite):
         pass
 
     def update_kinematics(self, dt):
-        displacement = self.velocity * dt
+        displacement = self.displacement.set_ip(self.velocity.x * dt, self.velocity.y * dt)
         self.position.x += displacement.x
 
         if self.wall_collision:
@@ -58,43 +58,18 @@ class BaseSprite(pygame.sprite.Sprite):
         pass
 
     def x_collision(self, displacement):
-        platform = self.platform_rect_check()
-        if platform is not None:
-            platform: pygame.Rect
-            if displacement.x > 0:  # Moved right, move it back left
-                self.position.x = platform.left - self.rw / 2 - dx
-            else:  # Moved left, move it back right
-                self.position.x = self.rw / 2 + platform.right + dx
-        return platform
+        """Moves the sprite out of the wall it hit when moving by displacement on x. Returns whether it hit one"""
+        x = Map.Map.instance.collide_box(self.position.x, self.position.y, self.rw / 2, self.rh / 2, displacement.x, 0)
+        collided = x != self.position.x
+        self.position.x = x
+        return collided
 
     def y_collision(self, displacement):
-        platform = self.platform_rect_check()
-        if platform is not None:
-            platform: pygame.Rect
-            if displacement.y > 0:  # Moved down, move it back up
-                self.position.y = platform.top - self.rh / 2 - dx
-            else:  # Moved up, move it back down
-                self.position.y = self.rh / 2 + platform.bottom + dx
-        return platform
-
-    def platform_rect_check(self) -> pygame.Rect:
-        hw = Vector2(self.rw / 2, 0)
-        hh = Vector2(0, self.rh / 2)
-
-        return self.platform_collision_check(self.position - hw + hh) or \
-               self.platform_collision_check(self.position + hw + hh) or \
-               self.platform_collision_check(self.position + hw - hh) or \
-               self.platform_collision_check(self.position - hw - hh)
-
-    @staticmethod
-    def platform_collision_check(point: Vector2) -> typing.Optional[pygame.Rect]:
-        try:
-            tile, rect = Map.Map.instance.get_tile_global(*point)
-            if tile != 0:
-                return pygame.Rect(*rect)
-            return None
-        except IndexError:
-            return None
+        """Moves the sprite out of the wall it hit when moving by displacement on y. Returns whether it hit one"""
+        y = Map.Map.instance.collide_box(self.position.x, self.position.y, self.rw / 2, self.rh / 2, displacement.y, 1)
+        collided = y != self.position.y
+        self.position.y = y
+        return collided
 
     def kill(self):
         super(BaseSprite, self).kill()
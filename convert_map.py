@@ -0,0 +1,23 @@
+"""
+Converts text maps to the binary map format FasterMap.Map.from_binary opens, e.g.
+    python convert_map.py Assets/MapsFiles/map.txt Assets/MapsFiles/map.rmap --sprites Assets/MapsFiles/sprites_map.pickle
+"""
+import argparse
+
+import FasterMap
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Converts a text map to a binary map')
+    parser.add_argument('map', help='text map of the walls')
+    parser.add_argument('output', help='binary map to write')
+    parser.add_argument('--floor', help='text map of the floor textures')
+    parser.add_argument('--ceiling', help='text map of the ceiling textures')
+    parser.add_argument('--sprites', help='JSON list of [[x, y], texture id], like sprites_map.pickle')
+    parser.add_argument('--tile-size', type=int, default=FasterMap.Map.TILE_SIZE)
+    args = parser.parse_args()
+    FasterMap.convert_text_map(args.map, args.output, args.floor, args.ceiling, args.sprites, args.tile_size)
+
+
+if __name__ == '__main__':
+    main()
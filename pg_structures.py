@@ -1,4 +1,4 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from glob import glob
 from pprint import pprint
 from time import time
@@ -9,6 +9,8 @@ from win32api import GetSystemMetrics
 from typing import Union
 from PIL import Image
 from pathlib import Path
+import hashlib
+import math
 import os
 
 
@@ -90,9 +92,46 @@ def draw_line_dashed(surface, color, start_pos, end_pos, width=1, dash_length=10
             for n in range(int(exclude_corners), dash_amount - int(exclude_corners), 3)]
 
 
+UnloadedTexture = namedtuple('UnloadedTexture', ('cls', 'path', 'scaled_resolution'))
+
+
+class TextureFolder(dict):
+    """
+    Folder of the textures registry. Textures are registered as UnloadedTexture and only decoded the first time they
+    are accessed
+    """
+
+    def __getitem__(self, key):
+        value = super(TextureFolder, self).__getitem__(key)
+        if isinstance(value, UnloadedTexture):
+            value = value.cls(value.path, value.scaled_resolution)
+            super(TextureFolder, self).__setitem__(key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def is_loaded(self, key):
+        return not isinstance(super(TextureFolder, self).__getitem__(key), UnloadedTexture)
+
+    def load_all(self):
+        """Loads every texture in this folder and its sub folders"""
+        for value in self.values():
+            if isinstance(value, TextureFolder):
+                value.load_all()
+
+
 class TextureMeta(type):
     def __init__(self, *args, **kwargs):
-        self.textures = {}
+        self.textures = TextureFolder()
         self.TEXTURES_DIRECTORY = r'Assets\Images'
 
         super(TextureMeta, self).__init__(*args, **kwargs)
@@ -129,36 +168,154 @@ class TextureMeta(type):
         return dir_dict
 
 
+class ScalingCache:
+    """Least recently used cache of scaled textures, bounded by the bytes of the surfaces it holds"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.surfaces = OrderedDict()  # (texture, height): scaled texture
+
+    @staticmethod
+    def surface_bytes(surface):
+        return surface.get_bytesize() * surface.get_width() * surface.get_height()
+
+    def get(self, key):
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+        return surface
+
+    def put(self, key, surface):
+        size = self.surface_bytes(surface)
+        if size > self.max_bytes:
+            return
+        self.pop(key)
+        self.surfaces[key] = surface
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.surfaces.popitem(last=False)
+            self.bytes -= self.surface_bytes(evicted)
+
+    def pop(self, key):
+        surface = self.surfaces.pop(key, None)
+        if surface is not None:
+            self.bytes -= self.surface_bytes(surface)
+
+    def discard(self, texture):
+        """Removes every scaled version of texture"""
+        for key in [key for key in self.surfaces if key[0] is texture]:
+            self.pop(key)
+
+    def clear(self):
+        self.surfaces.clear()
+        self.bytes = 0
+
+
+MipAtlas = namedtuple('MipAtlas', ('array', 'widths', 'heights', 'offsets'))
+
+
+def pack_mip_atlas(sizes, make_level, texel_shape=(), dtype=np.uint8):
+    """
+    Packs the mip chains of textures into one array, the levels of each texture side by side: level l of texture i
+    is array[i, offsets[i, l]:offsets[i, l] + max(1, widths[i] >> l), :max(1, heights[i] >> l)]
+    :param sizes: list of the (width, height) of the textures
+    :param make_level: function (index, level, level size) -> array of that level
+    :param texel_shape: shape of one texel, () for palette indices and (3, ) for RGB
+    :param dtype: type of the array
+    :return: MipAtlas
+    """
+    widths = np.asarray([width for width, _ in sizes])
+    heights = np.asarray([height for _, height in sizes])
+    levels = int(max(widths.max(), heights.max())).bit_length()  # down to 1x1
+
+    offsets = np.zeros((len(sizes), levels), np.int64)
+    for index, width in enumerate(widths):
+        for level in range(1, levels):
+            offsets[index, level] = offsets[index, level - 1] + max(1, width >> (level - 1))
+    total_width = max(offsets[index, -1] + max(1, width >> (levels - 1)) for index, width in enumerate(widths))
+
+    array = np.zeros((len(sizes), total_width, heights.max(), *texel_shape), dtype)
+    for index, (width, height) in enumerate(sizes):
+        for level in range(levels):
+            size = max(1, width >> level), max(1, height >> level)
+            offset = offsets[index, level]
+            array[index, offset:offset + size[0], :size[1]] = make_level(index, level, size)
+    return MipAtlas(array, widths, heights, offsets)
+
+
+def halve_keyed(rgb, colorkey):
+    """
+    Halves a (width, height, 3) array by averaging 2x2 blocks without their texels of colorkey, blocks of only colorkey
+    stay colorkey
+    """
+    width, height = rgb.shape[:2]
+    step_x, step_y = min(2, width), min(2, height)
+    blocks = rgb[:width // step_x * step_x, :height // step_y * step_y].astype(np.int64)
+    blocks = blocks.reshape(width // step_x, step_x, height // step_y, step_y, 3)
+    opaque = (blocks != colorkey).any(axis=-1)
+    counts = opaque.sum(axis=(1, 3))[..., np.newaxis]
+    sums = (blocks * opaque[..., np.newaxis]).sum(axis=(1, 3))
+    return np.where(counts > 0, sums // np.maximum(counts, 1), colorkey).astype(np.uint8)
+
+
 class Texture(metaclass=TextureMeta):
+    SCALING_CACHE = ScalingCache(64 * 1024 * 1024)  # shared by all textures
+    HEIGHT_BUCKET = 1.1  # heights are scaled to the nearest power of it, None to scale to the exact height
+
     @classmethod
     def textures_list(cls):
         files = cls[r'Textures\Mapped2']
         keys = filter(lambda filename: filename.isnumeric, files.keys())
         return [files[str(i)] for i in range(len((*keys,)))]
 
+    @staticmethod
+    def pack_atlas(textures):
+        """
+        Packs textures and their mipmaps into one array that can be passed to the compiled rasterizers
+        :param textures: list of textures (Texture)
+        :return: MipAtlas of RGB texels (see pack_mip_atlas)
+        """
+        return pack_mip_atlas([texture.mip_base().get_size() for texture in textures],
+                              lambda index, level, size: pg.surfarray.array3d(textures[index].mipmap(level)),
+                              (3, ))
+
     @classmethod
     def copy(cls, texture):
         return cls(texture.texture, texture.scaled_resolution)
 
     @classmethod
-    def initiate_handler(cls, resolution):
-        # create all textures from the assets folder recursively
+    def initiate_handler(cls, resolution, preload=()):
+        """
+        Registers all textures from the assets folder recursively. They are loaded on first access
+        :param resolution: scaled resolution of the textures
+        :param preload: paths (textures or directories) to load right away, e.g. what a map uses
+        """
         cls._initiate_handler(cls.TEXTURES_DIRECTORY, cls.textures, resolution)
+        cls.preload(preload)
 
     @classmethod
     def _initiate_handler(cls, folder, folder_dictionary, scaled_resolution):
-        # create all textures from the assets folder recursively
+        # register all textures from the assets folder recursively
         for item in os.listdir(folder):
             full_path = os.path.join(folder, item)
             if os.path.isdir(full_path):
-                folder_dictionary[item] = next = {}
+                folder_dictionary[item] = next = TextureFolder()
                 cls._initiate_handler(full_path, next, scaled_resolution)
             else:
                 if item.endswith('.png') or item.endswith('.jpg'):
                     filename = os.path.splitext(item)[0]  # remove the extension
                     if filename in folder_dictionary:
                         raise ValueError(f'Two textures named "{filename}"')
-                    folder_dictionary[filename] = cls(full_path, scaled_resolution)
+                    folder_dictionary[filename] = UnloadedTexture(cls, full_path, scaled_resolution)
+
+    @classmethod
+    def preload(cls, paths):
+        """Loads the given textures (or directories of textures) now instead of on first access"""
+        for path in paths:
+            texture = cls[path]
+            if isinstance(texture, TextureFolder):
+                texture.load_all()
 
     def __init__(self, image_or_path, scaled_resolution):
         if isinstance(image_or_path, str):
@@ -172,33 +329,72 @@ class Texture(metaclass=TextureMeta):
 
         self.scaled_resolution = scaled_resolution
 
-        self.scaling_cache = {}  # height: scaled texture
+        self.scaling_cache = self.SCALING_CACHE
+        self.mipmaps = None  # built on first use, see mipmap
 
     def change_resolution(self, new_resolution):
         self.scaled_resolution = new_resolution
         if self.scaling_cache is not None:
-            self.scaling_cache.clear()
+            self.scaling_cache.discard(self)
 
     def disable_scale_caching(self):
         self.scaling_cache = None
 
+    def mip_base(self):
+        """The surface the mip chain is built from"""
+        return self.texture
+
+    def mipmap(self, level):
+        """
+        Returns the texture halved level times (every level is smooth scaled from the one before, down to 1x1).
+        The colorkey of a colorkeyed texture is left out of the averages, so it doesn't bleed into the edges
+        """
+        if self.mipmaps is None:
+            self.mipmaps = [self.mip_base()]
+            colorkey = self.mipmaps[0].get_colorkey()
+            while self.mipmaps[-1].get_size() != (1, 1):
+                width, height = self.mipmaps[-1].get_size()
+                if colorkey is None:
+                    self.mipmaps.append(pg.transform.smoothscale(self.mipmaps[-1], (max(1, width // 2),
+                                                                                    max(1, height // 2))))
+                else:
+                    halved = pg.surfarray.make_surface(halve_keyed(pg.surfarray.array3d(self.mipmaps[-1]),
+                                                                   colorkey[:3]))
+                    halved.set_colorkey(colorkey)
+                    self.mipmaps.append(halved)
+        return self.mipmaps[min(level, len(self.mipmaps) - 1)]
+
+    def bucket_height(self, full_height):
+        """The height full_height is scaled to, so the cache is hit by close heights as well"""
+        if self.HEIGHT_BUCKET is None or full_height <= 0:
+            return full_height
+        return max(1, round(self.HEIGHT_BUCKET ** round(math.log(full_height, self.HEIGHT_BUCKET))))
+
     def get_stripe(self, x, full_height, stripe_y_start, stripe_height):
-        if (self.scaling_cache is None) or (full_height not in self.scaling_cache):
-            # print("scaling", full_height)
-            scaled_texture = pg.transform.scale(self.texture, (self.scaled_resolution * self.texture.get_width(),
-                                                               full_height))
+        height = self.bucket_height(full_height)
+        scaled_texture = None if self.scaling_cache is None else self.scaling_cache.get((self, height))
+        if scaled_texture is None:
+            level = 0  # scale down from the smallest mipmap that is still taller than height
+            while self.mipmap(level + 1) is not self.mipmap(level) and self.mipmap(level + 1).get_height() >= height:
+                level += 1
+            scaled_texture = pg.transform.scale(self.mipmap(level), (self.scaled_resolution * self.texture.get_width(),
+                                                                     height))
             if self.scaling_cache is not None:
-                self.scaling_cache[full_height] = scaled_texture
-        else:
-            # print("taking from cache", full_height)
-            scaled_texture = self.scaling_cache[full_height]
+                self.scaling_cache.put((self, height), scaled_texture)
         # if col_height > 0 and col_start < tex_height:
         try:
             resolution = self.scaled_resolution
             start = round(x) * resolution
             if start + resolution > scaled_texture.get_width():
                 resolution = self.scaled_resolution.get_width() - start
-            return scaled_texture.subsurface((start, stripe_y_start, resolution, stripe_height))
+            if height == full_height:
+                return scaled_texture.subsurface((start, stripe_y_start, resolution, stripe_height))
+
+            ratio = height / full_height  # take the stripe from the bucket and scale only it to the real height
+            bucket_y_start = int(stripe_y_start * ratio)
+            bucket_stripe_height = min(max(1, round(stripe_height * ratio)), height - bucket_y_start)
+            stripe = scaled_texture.subsurface((start, bucket_y_start, resolution, bucket_stripe_height))
+            return pg.transform.scale(stripe, (resolution, stripe_height))
         except Exception as e:
             pass
             # raise e
@@ -207,19 +403,33 @@ class Texture(metaclass=TextureMeta):
         value = transform_function(self.texture, *args, **kwargs)
         if set_to_new:
             self.texture = value
+            self.mipmaps = None
+            if self.scaling_cache is not None:
+                self.scaling_cache.discard(self)
 
 
 class IndexedTexture(Texture):
     uniform_size = (64, 64)
 
-    total_palette = pygame.Surface((0, 0))
+    total_palette = pygame.Surface((0, 0))  # every indexed texture side by side, as quantized last
 
-    indexed = []  # (subsurface, self)
+    indexed = []  # every indexed texture, in the order they are laid in total_palette
     palette = ((0, 0, 0, 255), ) * 256
 
-    def __init__(self, texture: Texture, resize_to_uniform):
+    # .npy arrays of the indexed textures, by palette and cache key (see get_cache_key). None to disable the cache
+    CACHE_DIRECTORY = os.path.join('Assets', 'Cache', 'indexed_textures')
+    PALETTE_CHUNK = 4096  # pixels palette_indices maps at once
+
+    def __init__(self, texture: Texture, resize_to_uniform, quantize=True):
+        """
+        :param texture: texture to index (Texture)
+        :param resize_to_uniform: whether to resize the texture to uniform_size
+        :param quantize: whether to quantize all indexed textures again right away. Pass False when indexing many
+            textures and call quantize_all once after (see index_all)
+        """
         super(IndexedTexture, self).__init__(texture.texture, texture.scaled_resolution)
         self.array = None
+        self.indexed_texture: pygame.Surface = None
         self.resize_to_uniform = resize_to_uniform
         text = texture.texture
         if self.resize_to_uniform:
@@ -227,16 +437,8 @@ class IndexedTexture(Texture):
                 self.uniform_size = text.get_size()
             else:
                 text = pygame.transform.scale(text, self.uniform_size)
-
-        rect = text.get_rect(topleft=(self.total_palette.get_width(), 0))
-        if self.total_palette.get_size() == (0, 0):
-            IndexedTexture.total_palette = text.copy()
-        else:
-            new = pg.Surface((self.total_palette.get_width() + text.get_width(),
-                              max(self.total_palette.get_height(), text.get_height())))
-            new.blit(IndexedTexture.total_palette, (0, 0))
-            new.blit(text, (self.total_palette.get_width(), 0))
-            IndexedTexture.total_palette = new
+        self.source = text  # what is quantized
+        self.cache_key = self.get_cache_key(texture.path, resize_to_uniform and self.uniform_size)
 
         if texture.path is not None:  # save self instead of texture
 
@@ -247,20 +449,167 @@ class IndexedTexture(Texture):
                 dir_dict = dir_dict[part]
             dir_dict[p.stem] = self
 
-        filepath = 'temp.png'
-        pygame.image.save(IndexedTexture.total_palette, filepath)
-        im = Image.open(filepath)
-        im = im.quantize(colors=256, method=2)
-        im.save('temp.png')
-        self.indexed.append((rect, self))
-        full_indexed_texture = pg.image.load('temp.png')
-        IndexedTexture.palette = full_indexed_texture.get_palette()
-        self.indexed_texture: pygame.Surface
-        for rect, texture in self.indexed:
-            texture.indexed_texture = full_indexed_texture.subsurface(rect).copy()
-            texture.load_array()
-
-        os.remove('temp.png')
+        self.indexed.append(self)
+        if quantize:
+            self.quantize_all()
+
+    @classmethod
+    def index_all(cls, textures, resize_to_uniform):
+        """
+        Indexes all textures and quantizes them (with every texture indexed before) in one pass
+        :param textures: textures to index (list of Texture)
+        :param resize_to_uniform: whether to resize the textures to uniform_size
+        :return: list of the indexed textures (IndexedTexture)
+        """
+        indexed = [cls(texture, resize_to_uniform, False) for texture in textures]
+        cls.quantize_all()
+        return indexed
+
+    @staticmethod
+    def get_cache_key(path, size):
+        """Hash of the source file path, size and modification time, None if the texture has no file"""
+        if path is None or not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        key = f'{os.path.abspath(path)}|{size}|{stat.st_size}|{stat.st_mtime_ns}'
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    @classmethod
+    def cache_directory(cls, palette):
+        """The cache keeps the arrays indexed with each palette in a directory of its own, named by its hash"""
+        return os.path.join(cls.CACHE_DIRECTORY, hashlib.sha1(np.asarray(palette, np.uint8).tobytes()).hexdigest())
+
+    @classmethod
+    def load_cache(cls, keys):
+        """
+        Returns the cached palette most of keys were indexed with and a dictionary of cache key: indexed array of
+        those keys (None and {} if there's no cache). The arrays are memory mapped, so only what is used is read
+        """
+        if cls.CACHE_DIRECTORY is None or not os.path.isdir(cls.CACHE_DIRECTORY):
+            return None, {}
+        directory, found = None, []
+        for name in os.listdir(cls.CACHE_DIRECTORY):
+            palette_directory = os.path.join(cls.CACHE_DIRECTORY, name)
+            if not os.path.isfile(os.path.join(palette_directory, 'palette.npy')):
+                continue
+            cached = [key for key in keys if os.path.isfile(os.path.join(palette_directory, f'{key}.npy'))]
+            if directory is None or len(cached) > len(found):
+                directory, found = palette_directory, cached
+        if directory is None:
+            return None, {}
+        palette = tuple(map(tuple, np.load(os.path.join(directory, 'palette.npy')).tolist()))
+        return palette, {key: np.load(os.path.join(directory, f'{key}.npy'), mmap_mode='r') for key in found}
+
+    @classmethod
+    def save_cache(cls, textures):
+        """Adds textures, indexed with the shared palette, to the cache. The other cached arrays are kept"""
+        if cls.CACHE_DIRECTORY is None:
+            return
+        directory = cls.cache_directory(cls.palette)
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'palette.npy'), np.asarray(cls.palette, np.uint8))
+        for texture in textures:
+            if texture.cache_key is not None:
+                np.save(os.path.join(directory, f'{texture.cache_key}.npy'), texture.array)
+
+    @classmethod
+    def quantize_all(cls):
+        """
+        Quantizes every indexed texture to one shared palette, in memory.
+        Textures found in the cache (unchanged since it was saved) are not quantized again, new or changed textures are
+        mapped to the cached palette
+        """
+        if not cls.indexed:
+            return
+        palette, cached = cls.load_cache([texture.cache_key for texture in cls.indexed if texture.cache_key])
+        missing = [texture for texture in cls.indexed if texture.cache_key not in cached]
+        if palette is None or len(missing) * 2 > len(cls.indexed):  # the cached palette doesn't fit most textures
+            cls.quantize(cls.indexed, None)
+            missing = cls.indexed  # all of them are indexed with the new palette
+        else:
+            IndexedTexture.palette = palette
+            for texture in cls.indexed:
+                if texture.cache_key in cached:
+                    texture.set_array(cached[texture.cache_key])
+            if missing:
+                cls.quantize(missing, palette)
+
+        if missing:
+            cls.save_cache(missing)
+
+    @classmethod
+    def quantize(cls, textures, palette):
+        """
+        Quantizes textures in one pass
+        :param textures: list of IndexedTexture
+        :param palette: palette to map the textures to, None to find a new one (and set it as the shared palette)
+        """
+        width = sum(texture.source.get_width() for texture in textures)
+        height = max(texture.source.get_height() for texture in textures)
+        total_palette = pg.Surface((width, height))
+        rects = []
+        left = 0
+        for texture in textures:
+            rects.append(total_palette.blit(texture.source, (left, 0)))
+            left += texture.source.get_width()
+        IndexedTexture.total_palette = total_palette
+
+        image = Image.frombytes('RGB', total_palette.get_size(), pg.image.tostring(total_palette, 'RGB'))
+        if palette is None:
+            image = image.quantize(colors=256, method=2)
+            colors = image.getpalette()[:256 * 3]
+            colors += [0] * (256 * 3 - len(colors))
+            IndexedTexture.palette = tuple((*colors[i:i + 3], 255) for i in range(0, 256 * 3, 3))
+        else:
+            palette_image = Image.new('P', (1, 1))
+            palette_image.putpalette([channel for color in palette for channel in color[:3]])
+            image = image.quantize(palette=palette_image, dither=0)
+
+        indices = np.asarray(image).T  # (width, height) like surfarray
+        for rect, texture in zip(rects, textures):
+            texture.set_array(indices[rect.left:rect.right, rect.top:rect.bottom].copy())
+
+    def mip_base(self):
+        return self.source
+
+    @classmethod
+    def palette_indices(cls, rgb):
+        """
+        Maps a (width, height, 3) RGB array to the closest colors of the shared palette, PALETTE_CHUNK pixels at a time
+        so the (pixels, colors) distances stay small for any texture size
+        """
+        palette = np.asarray(cls.palette, np.int64)[:, :3]
+        # |pixel - color|^2 = |pixel|^2 - 2 pixel.color + |color|^2, the pixel's own term doesn't change the closest.
+        # Every term is an integer below 2^24, so float32 (for the fast matrix product) is exact
+        products = (-2 * palette).T.astype(np.float32)
+        color_terms = (palette ** 2).sum(axis=-1).astype(np.float32)
+        pixels = rgb.reshape(-1, 3)
+        indices = np.empty(len(pixels), np.uint8)
+        for start in range(0, len(pixels), cls.PALETTE_CHUNK):
+            distances = pixels[start:start + cls.PALETTE_CHUNK].astype(np.float32) @ products
+            distances += color_terms
+            indices[start:start + cls.PALETTE_CHUNK] = distances.argmin(axis=-1)
+        return indices.reshape(rgb.shape[:2])
+
+    @classmethod
+    def pack_indexed_atlas(cls, textures):
+        """
+        Packs indexed textures and their mipmaps into one array that can be passed to the floor and ceiling kernels.
+        Mipmaps are smooth scaled in RGB and mapped back to the shared palette
+        :param textures: list of indexed textures (IndexedTexture)
+        :return: MipAtlas of palette indices (see pack_mip_atlas)
+        """
+        def make_level(index, level, size):
+            if level == 0:
+                return textures[index].array
+            return cls.palette_indices(pg.surfarray.array3d(textures[index].mipmap(level)))
+
+        return pack_mip_atlas([texture.array.shape for texture in textures], make_level)
+
+    def set_array(self, array):
+        self.array = array
+        self.indexed_texture = pg.surfarray.make_surface(self.array)
+        self.indexed_texture.set_palette(self.palette)
 
     def load_array(self):
         self.array = pg.surfarray.array2d(
@@ -308,6 +657,37 @@ class Timer:
         return self.delay - (time() - self.start_time)
 
 
+class ProfilerHUD:
+    """Overlay of the frame time and the per stage percentiles of a structures.FrameProfiler"""
+
+    def __init__(self, profiler, font, color=pg.Color('white'), refresh=.5):
+        self.profiler = profiler
+        self.font = font
+        self.color = color
+        self.timer = Timer(refresh)  # the text is rendered again only every refresh seconds
+        self.lines = []
+
+    def text(self):
+        summary = self.profiler.summary()
+        lines = []
+        frame = summary.get(self.profiler.FRAME)
+        if frame is not None:
+            lines.append(f'{1 / frame["mean"] if frame["mean"] else 0:.0f} fps')
+        for name, stats in summary.items():
+            lines.append(f'{name}: {stats["p50"] * 1000:.1f} / {stats["p95"] * 1000:.1f} / '
+                         f'{stats["p99"] * 1000:.1f} ms')
+        return lines
+
+    def draw(self, screen, position=(0, 0)):
+        if self.timer.finished():
+            self.lines = [self.font.render(line, False, self.color) for line in self.text()]
+            self.timer.activate()
+        x, y = position
+        for line in self.lines:
+            screen.blit(line, (x, y))
+            y += line.get_height()
+
+
 class Animation:
     """Collection class to make animations easier"""
     Frame = namedtuple('Frame', ('image', 'delay'))
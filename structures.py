@@ -1,7 +1,11 @@
+from collections import deque
 from dataclasses import dataclass, asdict, astuple
 from typing import Union
 from enum import Enum, auto
 from threading import Thread
+import time
+import json
+import csv
 import math
 
 
@@ -66,6 +70,133 @@ class PrivateConstructor(metaclass=PrivateConstructorMeta):
     pass
 
 
+def percentile(sorted_values, q):
+    """q-th percentile (0 to 100) of sorted_values, linearly interpolated"""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+
+class ProfilerScope:
+    """Times a block of code into the current frame of a FrameProfiler, use with `with`"""
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        current = self.profiler.current
+        current[self.name] = current.get(self.name, 0) + time.perf_counter() - self.start
+
+
+class FrameProfiler:
+    """
+    Named timing scopes per frame, kept for the last `window` frames for rolling percentiles.
+    Usage:
+        with profiler.scope('render_rays'):
+            ...
+        profiler.end_frame()  # once per frame, also times the whole frame as 'frame'
+    Times are in seconds
+    """
+    FRAME = 'frame'
+
+    def __init__(self, window=600, enabled=True):
+        self.window = window
+        self.enabled = enabled
+        self.scopes = {}
+        self.current = {}  # stage: time of the frame being profiled
+        self.stages = []  # in order of first appearance
+        self.history = {}  # stage: deque of its times over the last frames (0 on frames it didn't run)
+        self.frames = deque(maxlen=window)  # frame indices of history
+        self.frame_count = 0
+        self.frame_start = None
+
+    def scope(self, name):
+        if not self.enabled:
+            return NullScope
+        scope = self.scopes.get(name)
+        if scope is None:
+            scope = self.scopes[name] = ProfilerScope(self, name)
+        return scope
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.frame_start is not None:
+            self.current[self.FRAME] = now - self.frame_start
+        self.frame_start = now
+
+        for name in self.current:
+            if name not in self.history:
+                self.stages.append(name)
+                self.history[name] = deque([0.0] * len(self.frames), maxlen=self.window)
+        for name in self.stages:
+            self.history[name].append(self.current.get(name, 0.0))
+        self.frames.append(self.frame_count)
+        self.frame_count += 1
+        self.current = {}
+
+    def percentiles(self, name, qs=(50, 95, 99)):
+        values = sorted(self.history.get(name, ()))
+        return tuple(percentile(values, q) for q in qs)
+
+    def summary(self):
+        """stage: {'mean', 'p50', 'p95', 'p99', 'max'} over the window, in seconds"""
+        summary = {}
+        for name in self.stages:
+            values = sorted(self.history[name])
+            if values:
+                p50, p95, p99 = (percentile(values, q) for q in (50, 95, 99))
+                summary[name] = {'mean': sum(values) / len(values), 'p50': p50, 'p95': p95, 'p99': p99,
+                                 'max': values[-1]}
+        return summary
+
+    def rows(self):
+        """Yields the frames of the window as (frame index, time of each stage in self.stages)"""
+        for i, frame in enumerate(self.frames):
+            yield (frame, *(self.history[name][i] for name in self.stages))
+
+    def export_csv(self, path):
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(('frame_index', *self.stages))
+            writer.writerows(self.rows())
+
+    def export_json(self, path):
+        with open(path, 'w') as file:
+            json.dump({'stages': self.stages, 'summary': self.summary(), 'frames': list(self.rows())}, file, indent=1)
+
+    def export(self, path):
+        """Exports as JSON or CSV by the extension of path"""
+        if str(path).lower().endswith('.json'):
+            self.export_json(path)
+        else:
+            self.export_csv(path)
+
+
+class _NullScope:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NullScope = _NullScope()
+
+
 class VectorType(Enum):
     cartesian = 1
     polar = 2
@@ -160,6 +291,16 @@ class RotationMatrix:
             return Vector2(self.m00 * other.x + self.m10 * other.y, self.m01 * other.x + self.m11 * other.y)
         return NotImplemented
 
+    def set_angle(self, angle, radians=False):
+        """Reuses the matrix for another angle instead of creating a new one"""
+        if not radians:
+            angle = math.radians(angle)
+        self.m00 = math.cos(angle)
+        self.m10 = -math.sin(angle)
+        self.m01 = -self.m10
+        self.m11 = self.m00
+        return self
+
     def __rmul__(self, other):
         return self * other
 
@@ -180,6 +321,8 @@ RotationMatrix.init()
 
 
 class Vector2:
+    __slots__ = ('x', 'y')
+
     def __init__(self, x, y):  # parm = (r, theta) or (x, y)
         self.x = x
         self.y = y
@@ -211,6 +354,57 @@ class Vector2:
         self.x = x or self.x
         self.y = y or self.y
 
+    # in place operations, they don't allocate a new vector and return self (or out) to allow chaining
+
+    def set_ip(self, x, y):
+        self.x = x
+        self.y = y
+        return self
+
+    def normalize_ip(self):
+        mag = math.hypot(self.x, self.y)
+        self.x /= mag
+        self.y /= mag
+        return self
+
+    def scale_ip(self, scalar):
+        self.x *= scalar
+        self.y *= scalar
+        return self
+
+    def rotate_ip(self, matrix):
+        """Rotates by a RotationMatrix"""
+        x = self.x
+        self.x = matrix.m00 * x + matrix.m10 * self.y
+        self.y = matrix.m01 * x + matrix.m11 * self.y
+        return self
+
+    def tangent_ip(self):
+        self.x, self.y = -self.y, self.x
+        return self
+
+    def add_into(self, other, out):
+        """out = self + other"""
+        out.x = self.x + other[0]
+        out.y = self.y + other[1]
+        return out
+
+    def sub_into(self, other, out):
+        """out = self - other"""
+        out.x = self.x - other[0]
+        out.y = self.y - other[1]
+        return out
+
+    def camera_basis(self, camera_plane_length):
+        """
+        Returns the normalized direction and the camera plane (its tangent scaled to camera_plane_length) as
+        dir_x, dir_y, plane_x, plane_y floats, without allocating vectors
+        """
+        mag = math.hypot(self.x, self.y)
+        dir_x = self.x / mag
+        dir_y = self.y / mag
+        return dir_x, dir_y, -dir_y * camera_plane_length, dir_x * camera_plane_length
+
     def __round__(self, n=None):
         return Vector2(round(self.x, n), round(self.y, n))
 
@@ -278,8 +472,9 @@ class Vector2:
 
     def __imul__(self, other):
         if isinstance(other, (int, float)):
-            self.r *= other
-            return self
+            return self.scale_ip(other)
+        if isinstance(other, RotationMatrix):
+            return self.rotate_ip(other)
         return NotImplemented
 
     def __rmul__(self, other):
@@ -0,0 +1,82 @@
+import math
+
+import numpy as np
+import pytest
+
+import FasterMap
+
+
+@pytest.fixture
+def room():
+    """A walled 256x256 room with scattered pillars, and its distance field"""
+    rng = np.random.default_rng(0)
+    tiles = (rng.random((256, 256)) < .002).astype(np.uint8) * 3
+    tiles[[0, -1], :] = 1
+    tiles[:, [0, -1]] = 1
+    FasterMap.Map.instance = None
+    map_ = FasterMap.Map(tiles, None, None)
+    map_.build_distance_field()
+    yield map_
+    FasterMap.Map.instance = None
+
+
+def chebyshev(tiles, cap):
+    """The distance field, the slow way"""
+    height, width = tiles.shape
+    walls = np.argwhere(tiles != 0)
+    distances = np.zeros(tiles.shape, np.int64)
+    for y in range(height):
+        for x in range(width):
+            distance = min(x + 1, y + 1, width - x, height - y)
+            if len(walls):
+                distance = min(distance, np.abs(walls - (y, x)).max(axis=1).min())
+            distances[y, x] = min(distance, cap)
+    return distances
+
+
+def test_distance_field_updates_incrementally():
+    rng = np.random.default_rng(1)
+    FasterMap.Map.instance = None
+    map_ = FasterMap.Map((rng.random((30, 40)) < .03).astype(np.uint8), None, None)
+    map_.build_distance_field(8)
+    assert np.array_equal(map_.distances, chebyshev(map_.map(), 8))
+    for _ in range(30):
+        x, y = rng.integers(0, 40), rng.integers(0, 30)
+        map_.set_tile(x, y, rng.integers(0, 2))
+        assert np.array_equal(map_.distances, chebyshev(map_.map(), 8))
+    FasterMap.Map.instance = None
+
+
+@pytest.mark.parametrize('magnitude', [1.0, 1 / math.cos(math.radians(30)), math.sqrt(2), 3.0, .5])
+def test_leaping_matches_stepping(room, magnitude):
+    """Screen rays are dir + camera * x, which isn't a unit vector"""
+    rng = np.random.default_rng(2)
+    tiles = room.map()
+    widths = np.full(4, 64, np.int64)
+    for _ in range(3000):
+        x, y = rng.uniform(1, 255, 2)
+        angle = rng.uniform(0, 2 * math.pi)
+        direction = math.cos(angle) * magnitude, math.sin(angle) * magnitude
+        stepped = FasterMap.cast_ray(tiles, x, y, *direction, widths, FasterMap.no_visits, FasterMap.no_distances)
+        leaped = FasterMap.cast_ray(tiles, x, y, *direction, widths, FasterMap.no_visits, room.distances)
+        assert leaped[1:] == stepped[1:]
+        assert leaped[0] == pytest.approx(stepped[0], rel=1e-9, abs=1e-9)
+
+
+def test_screen_cast_matches_stepping(room):
+    W, H, resolution = 320, 200, 1
+    widths = np.full(4, 64, np.int64)
+    camera_plane_length = math.tan(math.radians(30))
+    for angle in np.linspace(0, 2 * math.pi, 32, endpoint=False):
+        dir_x, dir_y = math.cos(angle), math.sin(angle)
+        view = (W, resolution, room.map(), 128.5, 97.5, dir_x, -dir_y * camera_plane_length, dir_y,
+                dir_x * camera_plane_length, H, 0, 1, widths, widths)
+        results = []
+        for distances in (FasterMap.no_distances, room.distances):
+            columns = FasterMap.allocate_columns(W, resolution)
+            z_buffer = np.zeros(W, np.float64)
+            count = FasterMap.cast_screen_batch(columns, z_buffer, FasterMap.no_visits, distances, *view)
+            results.append((columns[:count], z_buffer))
+        (stepped_columns, stepped_z), (leaped_columns, leaped_z) = results
+        assert np.array_equal(stepped_columns[['x', 'tile_id', 'tex_x']], leaped_columns[['x', 'tile_id', 'tex_x']])
+        np.testing.assert_allclose(leaped_z, stepped_z, rtol=1e-9)
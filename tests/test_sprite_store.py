@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from Sprites3D.SpriteStore import SpriteStore
+
+
+@pytest.fixture
+def store():
+    """An empty store of capacity 0, left out of SpriteStore.update_all"""
+    store = SpriteStore(capacity=0)
+    yield store
+    SpriteStore.stores.remove(store)
+
+
+def test_grow_from_capacity_zero(store):
+    for index in range(5):
+        assert store.add('frame', (index, 2 * index), velocity=(1, 0)) == index
+    assert len(store) == 5
+    assert len(store.position) >= 5
+    assert all(len(getattr(store, name)) == len(store.position) for name in SpriteStore.ARRAYS)
+    np.testing.assert_array_equal(store.position[:5], [(index, 2 * index) for index in range(5)])
+    np.testing.assert_array_equal(store.velocity[:5], [(1, 0)] * 5)
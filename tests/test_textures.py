@@ -0,0 +1,112 @@
+import collections
+import os
+
+import numpy as np
+import pytest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+pytest.importorskip('win32api')  # pg_structures needs it for the screen size
+pg = pytest.importorskip('pygame')
+
+import pg_structures
+
+
+@pytest.fixture(scope='module', autouse=True)
+def display():
+    pg.init()
+    pg.display.set_mode((1, 1))  # textures are converted to the display format
+    yield
+    pg.quit()
+
+
+@pytest.fixture
+def indexed(monkeypatch):
+    monkeypatch.setattr(pg_structures.IndexedTexture, 'CACHE_DIRECTORY', None)
+    monkeypatch.setattr(pg_structures.IndexedTexture, 'indexed', [])
+
+
+def surface(size, color):
+    image = pg.Surface(size)
+    image.fill(color)
+    return image
+
+
+def test_pack_atlas_of_indexed_textures(indexed):
+    """Like Textures\\Mapped2: small textures resized to IndexedTexture.uniform_size"""
+    textures = [pg_structures.Texture(surface((8, 8), color), 1) for color in ((200, 0, 0), (0, 200, 0), (0, 0, 200))]
+    textures = pg_structures.IndexedTexture.index_all(textures, True)
+
+    atlas = pg_structures.Texture.pack_atlas(textures)
+    width, height = pg_structures.IndexedTexture.uniform_size
+    assert list(atlas.widths) == [width] * 3 and list(atlas.heights) == [height] * 3
+    assert atlas.array.shape[:3] == (3, atlas.offsets[0, -1] + 1, height)
+    assert tuple(atlas.array[1, 0, 0]) == (0, 200, 0)
+
+    indexed_atlas = pg_structures.IndexedTexture.pack_indexed_atlas(textures)
+    assert list(indexed_atlas.widths) == list(atlas.widths)
+
+
+def test_colorkey_does_not_bleed_into_mipmaps():
+    image = surface((16, 16), (0, 255, 255))
+    image.fill((200, 100, 50), (0, 0, 5, 16))  # odd width, so the edge blocks mix colour and colorkey
+    image.set_colorkey((0, 255, 255))
+    texture = pg_structures.Texture(image, 1)
+
+    for level in range(1, 5):
+        mipmap = texture.mipmap(level)
+        assert mipmap.get_colorkey() == image.get_colorkey()
+        colors = {tuple(color) for color in pg.surfarray.array3d(mipmap).reshape(-1, 3)}
+        assert colors <= {(200, 100, 50), (0, 255, 255)}
+
+
+def test_halve_keyed():
+    rgb = np.zeros((3, 2, 3), np.uint8)
+    rgb[0, 0] = 100
+    rgb[1, 1] = 50
+    halved = pg_structures.halve_keyed(rgb, (0, 0, 0))
+    assert halved.shape == (1, 1, 3)
+    assert tuple(halved[0, 0]) == (75, 75, 75)
+
+
+def test_cache_is_memory_mapped_and_keeps_other_entries(indexed, monkeypatch, tmp_path):
+    monkeypatch.setattr(pg_structures.IndexedTexture, 'CACHE_DIRECTORY', str(tmp_path / 'cache'))
+
+    def folders():  # indexed textures with a path replace their Texture in the folders of Texture.textures
+        return collections.defaultdict(folders)
+
+    monkeypatch.setattr(pg_structures.Texture, 'textures', folders())
+    paths = []
+    for index, color in enumerate(((200, 0, 0), (0, 200, 0), (0, 0, 200), (200, 200, 0))):
+        paths.append(str(tmp_path / f'{index}.png'))
+        pg.image.save(surface((8, 8), color), paths[-1])
+
+    def index(paths):
+        monkeypatch.setattr(pg_structures.IndexedTexture, 'indexed', [])
+        textures = [pg_structures.Texture(path, 1) for path in paths]
+        return pg_structures.IndexedTexture.index_all(textures, False)
+
+    index(paths[:3])
+    index([paths[0], paths[3]])  # adds a texture to the cache without dropping the ones this session didn't use
+
+    keys = [texture.cache_key for texture in pg_structures.IndexedTexture.indexed]
+    palette, cached = pg_structures.IndexedTexture.load_cache([texture.cache_key for texture in index(paths)])
+    assert palette == pg_structures.IndexedTexture.palette
+    assert len(cached) == 4 and set(keys) <= set(cached)
+    assert all(isinstance(array, np.memmap) for array in cached.values())
+    for texture in index(paths):
+        assert isinstance(texture.array, np.memmap)
+        np.testing.assert_array_equal(texture.array, cached[texture.cache_key])
+
+
+def test_palette_indices_in_chunks(monkeypatch):
+    rng = np.random.default_rng(0)
+    palette = tuple((*rng.integers(0, 256, 3).tolist(), 255) for _ in range(256))
+    monkeypatch.setattr(pg_structures.IndexedTexture, 'palette', palette)
+    monkeypatch.setattr(pg_structures.IndexedTexture, 'PALETTE_CHUNK', 100)
+    rgb = rng.integers(0, 256, (37, 29, 3)).astype(np.uint8)
+
+    colors = np.asarray(palette, np.int64)[:, :3]
+    expected = ((rgb[:, :, np.newaxis, :].astype(np.int64) - colors) ** 2).sum(axis=-1).argmin(axis=-1)
+    indices = pg_structures.IndexedTexture.palette_indices(rgb)
+    assert indices.dtype == np.uint8
+    np.testing.assert_array_equal(indices, expected)